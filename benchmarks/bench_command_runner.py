@@ -0,0 +1,102 @@
+import os
+import sys
+import time
+import shlex
+import tempfile
+import selectors
+import subprocess
+
+from provisioner import CommandRunner, ExecError
+
+
+class ReadlineCommandRunner(CommandRunner):
+    # The selector loop CommandRunner.exec used before reads became chunked:
+    # one readline() per wakeup and a log flush per line
+    def exec(self, cmd, cwd=None, env=None, log_name=""):
+        if cwd is None:
+            cwd = self.cwd
+        if env is None:
+            env = self.env
+        self.log_file.write(
+            f"{log_name}{cwd} % {' '.join([shlex.quote(term) for term in cmd])}\n"
+        )
+        self.log_file.flush()
+        process = subprocess.Popen(
+            cmd,
+            cwd=cwd,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        stdout_lines = []
+        stderr_lines = []
+        sel = selectors.DefaultSelector()
+        sel.register(process.stdout, selectors.EVENT_READ)
+        sel.register(process.stderr, selectors.EVENT_READ)
+        stdout_ok = True
+        stderr_ok = True
+        while stdout_ok or stderr_ok:
+            for key, _ in sel.select():
+                line = key.fileobj.readline()
+                if not line:
+                    if key.fileobj is process.stdout:
+                        stdout_ok = False
+                    else:
+                        stderr_ok = False
+                elif key.fileobj is process.stdout:
+                    self.log_file.write(f"{log_name}{line}")
+                    self.log_file.flush()
+                    stdout_lines.append(line)
+                else:
+                    self.log_file.write(f"{log_name}{line}")
+                    self.log_file.flush()
+                    stderr_lines.append(line)
+        process.communicate()
+        exit_code = process.wait()
+        stdout = "\n".join(stdout_lines)
+        stderr = "\n".join(stderr_lines)
+        if exit_code != 0:
+            raise ExecError(
+                exit_code, stdout, stderr, f"Exec failed: {stderr or stdout}"
+            )
+        return stdout, stderr
+
+
+# name -> python code writing lines of output, built up front so the
+# producer isn't the bottleneck
+PRODUCERS = {
+    "short lines": "import sys\nsys.stdout.write(''.join(f'{i}\\n' for i in range(500000)))",
+    "interleaved": "import sys\nfor i in range(1000):\n    sys.stdout.write(f'out {i}\\n' * 200); sys.stdout.flush(); sys.stderr.write(f'err {i}\\n' * 200)",
+    "wide lines": "import sys\nsys.stdout.write(('x' * 4000 + '\\n') * 20000)",
+    "one huge line": "import sys\nsys.stdout.write('x' * 50000000)",
+}
+
+
+def run(runner_class, code, repeat):
+    with tempfile.TemporaryDirectory() as tmp:
+        runner = runner_class(os.path.join(tmp, "bench.log"), env=dict(os.environ))
+        durations = []
+        size = 0
+        for _ in range(repeat):
+            start = time.perf_counter()
+            stdout, stderr = runner.exec([sys.executable, "-c", code])
+            durations.append(time.perf_counter() - start)
+            size = len(stdout) + len(stderr)
+        del runner
+    return min(durations), size
+
+
+def main(repeat=3):
+    print(f"{'producer':<16}{'readline MB/s':>16}{'chunked MB/s':>16}{'speedup':>10}")
+    for name, code in PRODUCERS.items():
+        before, size = run(ReadlineCommandRunner, code, repeat)
+        after, _ = run(CommandRunner, code, repeat)
+        mb = size / 1024 / 1024
+        print(
+            f"{name:<16}{mb / before:>16.1f}{mb / after:>16.1f}{before / after:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
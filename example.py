@@ -1,7 +1,7 @@
 import os
 import sys
 
-from provisioner import CommandRunner, AWSCommandRunner, StackProvisioner, parse_args
+from provisioner import CommandRunner, AWSCommandRunner, BucketManager, StackProvisioner, parse_args
 
 
 class OIDC:
@@ -70,7 +70,6 @@ class Publisher:
 
 if __name__ == "__main__":
     import argparse
-    import pprint
 
     parser = argparse.ArgumentParser()
     arg_groups = parse_args(
@@ -84,7 +83,25 @@ if __name__ == "__main__":
         ],
         sys.argv[1:],
     )
+    # Only once the arguments are valid, it's slow to import
+    import pprint
     pprint.pprint(arg_groups)
     command_runner = CommandRunner('example.log', env=os.environ.copy())
     aws_command_runner = AWSCommandRunner(command_runner, **arg_groups['aws'])
-    stack_provisioner = StackProvisioner(aws_command_runner, **arg_groups['stackprovisioner'])
+    global_postfix = arg_groups['stackprovisioner']['global_postfix']
+    bucket_manager = BucketManager(aws_command_runner, cache='.bucket-cache.json')
+    planning = arg_groups['stackprovisioner']['plan_file'] is not None
+    applying = arg_groups['stackprovisioner']['apply_file'] is not None
+    # A plan only reads, and applying one creates the bucket it found missing
+    if not planning and not applying:
+        bucket_manager.ensure_versioned_buckets([
+            arg_groups['stackprovisioner']['cloudformation_bucket'] + global_postfix,
+            arg_groups['frontend']['frontend_bucket'] + global_postfix,
+        ])
+    stack_provisioner = StackProvisioner(aws_command_runner, **arg_groups['stackprovisioner'], bucket_manager=bucket_manager)
+    if planning:
+        stack_provisioner.plan()
+    elif applying:
+        stack_provisioner.apply()
+    else:
+        stack_provisioner.deploy_stacks()
@@ -1,9 +1,40 @@
 import os
-import subprocess
-import shlex
-import selectors
+import re
+import time
 import json
+import random
 import argparse
+import importlib
+import threading
+import weakref
+import collections
+import io
+import codecs
+import contextvars
+
+from .files import walk_files, replace_file
+from .spans import span
+
+
+class _LazyModule:
+    # Stands in for a module until it's first used, so an entry point that
+    # only gets as far as parse_args, --help or a bad argument doesn't pay
+    # for importing asyncio, subprocess and the rest
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+
+asyncio = _LazyModule("asyncio")
+subprocess = _LazyModule("subprocess")
+selectors = _LazyModule("selectors")
+shlex = _LazyModule("shlex")
+tempfile = _LazyModule("tempfile")
+hashlib = _LazyModule("hashlib")
+datetime = _LazyModule("datetime")
+concurrent_futures = _LazyModule("concurrent.futures")
 
 
 class ExecError(OSError):
@@ -14,8 +45,73 @@ class ExecError(OSError):
         self.stderr = stderr
 
 
+class _OutputBuffer:
+    def __init__(self, max_output=None):
+        self.max_output = max_output
+        self.lines = collections.deque()
+        self.size = 0
+
+    def append(self, line):
+        if self.max_output is not None:
+            if self.max_output <= 0:
+                # line[-0:] would be the whole line
+                return
+            # Only keep the end, which is where the errors usually are
+            line = line[-self.max_output :]
+            self.size += len(line)
+            while self.size > self.max_output:
+                self.size -= len(self.lines.popleft())
+        self.lines.append(line)
+
+    def value(self):
+        return "\n".join(self.lines)
+
+
+class _LineSplitter:
+    def __init__(self, lines, on_line=None, encoding="utf8"):
+        self.lines = lines
+        self.on_line = on_line
+        # The same decoding and newline translation universal_newlines=True uses
+        self._decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder(encoding)(errors="replace"), translate=True
+        )
+        # Pieces of a line still waiting for its newline, only joined once it
+        # arrives so a huge line isn't copied on every read
+        self._partial = []
+
+    def feed(self, data):
+        # An empty chunk means the end of the stream
+        parts = self._decoder.decode(data, final=not data).split("\n")
+        lines = []
+        if len(parts) > 1:
+            self._partial.append(parts[0])
+            lines.append("".join(self._partial) + "\n")
+            lines += [part + "\n" for part in parts[1:-1]]
+            self._partial = []
+        if parts[-1]:
+            self._partial.append(parts[-1])
+        if not data and self._partial:
+            lines.append("".join(self._partial))
+            self._partial = []
+        for line in lines:
+            self.lines.append(line)
+            if self.on_line is not None:
+                self.on_line(line)
+        return lines
+
+
 class CommandRunner:
-    def __init__(self, logfilename, cwd: str | None = None, env: dict | None = None):
+    read_size = 64 * 1024
+    log_flush_size = 64 * 1024
+    log_flush_interval = 0.1
+
+    def __init__(
+        self,
+        logfilename,
+        cwd: str | None = None,
+        env: dict | None = None,
+        trace: str | None = None,
+    ):
         if cwd is None:
             self.cwd: str = os.getcwd()
         else:
@@ -25,64 +121,185 @@ class CommandRunner:
         else:
             self.env: dict = env
         self.log_file = open(logfilename, "w")
+        # exec() may be called from several threads at once (see StackProvisioner.deploy_stacks)
+        self._log_lock = threading.Lock()
+        # An optional JSON Lines file with one timed record per command, see
+        # provisioner.trace for a summary of it
+        self.trace_file = None
+        if trace is not None:
+            self.trace_file = open(trace, "w")
+
+    def written_files(self):
+        # Files this runner writes as it goes, never part of what's deployed
+        files = [self.log_file.name]
+        if self.trace_file is not None:
+            files.append(self.trace_file.name)
+        return files
 
     def __del__(self):
         self.log_file.close()
+        if self.trace_file is not None:
+            self.trace_file.close()
 
-    def exec(self, cmd, cwd=None, env=None, log_name=""):
+    def _write_log(self, text):
+        with self._log_lock:
+            self.log_file.write(text)
+            self.log_file.flush()
+
+    def log(self, message, log_name=""):
+        self._write_log(f"{log_name}{message}\n")
+
+    def _trace(self, argv, cwd, log_name, start, exit_code, stdout_bytes, stderr_bytes):
+        if self.trace_file is None:
+            return
+        end = time.monotonic()
+        record = {
+            "argv": argv,
+            "cwd": cwd,
+            "log_name": log_name,
+            "start": start,
+            "end": end,
+            "duration": end - start,
+            "exit_code": exit_code,
+            "stdout_bytes": stdout_bytes,
+            "stderr_bytes": stderr_bytes,
+        }
+        with self._log_lock:
+            self.trace_file.write(json.dumps(record) + "\n")
+            self.trace_file.flush()
+
+    def exec(
+        self,
+        cmd,
+        cwd=None,
+        env=None,
+        log_name="",
+        on_stdout=None,
+        on_stderr=None,
+        max_output=None,
+    ):
         if cwd is None:
             cwd = self.cwd
         if env is None:
             env = self.env
-        self.log_file.write(
-            f"{log_name}{cwd} % {' '.join([shlex.quote(term) for term in cmd])}\n"
-        )
-        self.log_file.flush()
-        process = subprocess.Popen(
-            cmd,
-            cwd=cwd,
-            env=env,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True,
-        )
-        stdout_lines = []
-        stderr_lines = []
-        # Read both stdout and stderr simultaneously
-        sel = selectors.DefaultSelector()
-        assert process.stdout is not None
-        assert process.stderr is not None
-        sel.register(process.stdout, selectors.EVENT_READ)
-        sel.register(process.stderr, selectors.EVENT_READ)
-        stdout_ok = True
-        stderr_ok = True
-        while stdout_ok or stderr_ok:
-            for key, _ in sel.select():
-                line = key.fileobj.readline()  #  type: ignore
-                if not line:
-                    if key.fileobj is process.stdout:
-                        stdout_ok = False
-                    else:
-                        stderr_ok = False
-                elif stdout_ok or stderr_ok:
-                    if key.fileobj is process.stdout:
-                        self.log_file.write(f"{log_name}{line}")
-                        self.log_file.flush()
-                        stdout_lines.append(line)
-                    else:
-                        self.log_file.write(f"{log_name}{line}")
-                        self.log_file.flush()
-                        stderr_lines.append(line)
-        # Calling this closes open files
-        o, e = process.communicate()
-        assert o == "", o
-        assert e == "", e
-        exit_code = process.wait()
+        command = " ".join([shlex.quote(term) for term in cmd])
+        self._write_log(f"{log_name}{cwd} % {command}\n")
+        with span(
+            "CommandRunner.exec", command=command, cwd=cwd, log_name=log_name
+        ) as trace_span:
+            start = time.monotonic()
+            process = subprocess.Popen(
+                cmd,
+                cwd=cwd,
+                env=env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            assert process.stdout is not None
+            assert process.stderr is not None
+            stdout_lines = _OutputBuffer(max_output)
+            stderr_lines = _OutputBuffer(max_output)
+            streams = {
+                process.stdout.fileno(): _LineSplitter(stdout_lines, on_stdout),
+                process.stderr.fileno(): _LineSplitter(stderr_lines, on_stderr),
+            }
+            sizes = {fd: 0 for fd in streams}
+            # Output is read in large chunks from the raw pipes so a long line
+            # can't block, and written to the log in batches rather than per line
+            log = []
+            log_size = 0
+            last_flush = time.monotonic()
+            sel = selectors.DefaultSelector()
+            for fd in streams:
+                sel.register(fd, selectors.EVENT_READ)
+            open_streams = len(streams)
+            while open_streams:
+                timeout = None
+                if log:
+                    timeout = max(
+                        0, last_flush + self.log_flush_interval - time.monotonic()
+                    )
+                for key, _ in sel.select(timeout):
+                    data = os.read(key.fd, self.read_size)
+                    sizes[key.fd] += len(data)
+                    if not data:
+                        sel.unregister(key.fd)
+                        open_streams -= 1
+                    for line in streams[key.fd].feed(data):
+                        # Even a last line with no newline is logged whole, so
+                        # commands running side by side never share a line
+                        log.append(
+                            f"{log_name}{line}"
+                            if line.endswith("\n")
+                            else f"{log_name}{line}\n"
+                        )
+                        log_size += len(line)
+                if log and (
+                    log_size >= self.log_flush_size
+                    or time.monotonic() - last_flush >= self.log_flush_interval
+                    or not open_streams
+                ):
+                    self._write_log("".join(log))
+                    log = []
+                    log_size = 0
+                    last_flush = time.monotonic()
+            sel.close()
+            # Calling this closes open files
+            o, e = process.communicate()
+            assert o == b"", o
+            assert e == b"", e
+            exit_code = process.wait()
+            stdout_bytes, stderr_bytes = sizes.values()
+            trace_span.set_attribute("exit_code", exit_code)
+            trace_span.set_attribute("stdout_bytes", stdout_bytes)
+            trace_span.set_attribute("stderr_bytes", stderr_bytes)
+            self._trace(
+                cmd, cwd, log_name, start, exit_code, stdout_bytes, stderr_bytes
+            )
+            return self._result(exit_code, stdout_lines, stderr_lines, log_name)
+
+    def run_many(
+        self,
+        cmds,
+        max_workers=8,
+        cwd=None,
+        env=None,
+        log_names=None,
+        max_output=None,
+    ):
+        if log_names is None:
+            log_names = [f"[{i}] " for i in range(len(cmds))]
+
+        def run(cmd, log_name):
+            try:
+                # The selector loop, even on an AsyncCommandRunner
+                return CommandRunner.exec(
+                    self,
+                    cmd,
+                    cwd=cwd,
+                    env=env,
+                    log_name=log_name,
+                    max_output=max_output,
+                )
+            except (ExecError, OSError) as e:
+                # Like a missing binary, which fails before it can exit non-zero
+                return e
+
+        with span("CommandRunner.run_many", commands=len(cmds)):
+            with concurrent_futures.ThreadPoolExecutor(
+                max_workers=max_workers
+            ) as executor:
+                futures = [
+                    executor.submit(contextvars.copy_context().run, run, cmd, log_name)
+                    for cmd, log_name in zip(cmds, log_names)
+                ]
+            return [future.result() for future in futures]
+
+    def _result(self, exit_code, stdout_lines, stderr_lines, log_name):
         if exit_code != 0:
-            self.log_file.write(f"{log_name}Exit code: {exit_code}\n")
-            self.log_file.flush()
-        stdout = "\n".join(stdout_lines)
-        stderr = "\n".join(stderr_lines)
+            self._write_log(f"{log_name}Exit code: {exit_code}\n")
+        stdout = stdout_lines.value()
+        stderr = stderr_lines.value()
         if exit_code != 0:
             raise ExecError(
                 exit_code, stdout, stderr, f"Exec failed: {stderr or stdout}"
@@ -90,7 +307,178 @@ class CommandRunner:
         return stdout, stderr
 
 
+class AsyncCommandRunner(CommandRunner):
+    # The selector loop is still available for callers that can't await, like
+    # the identity check in AWSCommandRunner.__init__
+    exec_blocking = CommandRunner.exec
+
+    async def exec(
+        self,
+        cmd,
+        cwd=None,
+        env=None,
+        log_name="",
+        on_stdout=None,
+        on_stderr=None,
+        max_output=None,
+    ):
+        if cwd is None:
+            cwd = self.cwd
+        if env is None:
+            env = self.env
+        command = " ".join([shlex.quote(term) for term in cmd])
+        self._write_log(f"{log_name}{cwd} % {command}\n")
+        with span(
+            "AsyncCommandRunner.exec", command=command, cwd=cwd, log_name=log_name
+        ) as trace_span:
+            start = time.monotonic()
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                cwd=cwd,
+                env=env,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            stdout_lines = _OutputBuffer(max_output)
+            stderr_lines = _OutputBuffer(max_output)
+
+            sizes = [0, 0]
+
+            async def read(stream, lines, on_line, index):
+                # Chunks rather than readline(), which gives up on a line
+                # longer than the stream's limit, decoded like exec()
+                splitter = _LineSplitter(lines, on_line)
+                while True:
+                    data = await stream.read(self.read_size)
+                    sizes[index] += len(data)
+                    log = [
+                        f"{log_name}{line}"
+                        if line.endswith("\n")
+                        else f"{log_name}{line}\n"
+                        for line in splitter.feed(data)
+                    ]
+                    if log:
+                        self._write_log("".join(log))
+                    if not data:
+                        break
+
+            assert process.stdout is not None
+            assert process.stderr is not None
+            await asyncio.gather(
+                read(process.stdout, stdout_lines, on_stdout, 0),
+                read(process.stderr, stderr_lines, on_stderr, 1),
+            )
+            exit_code = await process.wait()
+            trace_span.set_attribute("exit_code", exit_code)
+            trace_span.set_attribute("stdout_bytes", sizes[0])
+            trace_span.set_attribute("stderr_bytes", sizes[1])
+            self._trace(cmd, cwd, log_name, start, exit_code, *sizes)
+            return self._result(exit_code, stdout_lines, stderr_lines, log_name)
+
+
+# Error codes, from "An error occurred (<code>)" in the CLI's stderr, that mean
+# the request was turned away and can be sent again
+THROTTLING_ERRORS = {
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottled",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+    "BandwidthLimitExceeded",
+    "SlowDown",
+    "PriorRequestNotComplete",
+    "ProvisionedThroughputExceededException",
+}
+TRANSIENT_ERRORS = {
+    "RequestTimeout",
+    "RequestTimeoutException",
+    "InternalError",
+    "InternalFailure",
+    "InternalServerError",
+    "ServiceUnavailable",
+    "ServiceUnavailableException",
+}
+# What the CLI and botocore print when the request never got an answer
+CONNECTION_ERRORS = [
+    "Could not connect to the endpoint URL",
+    "Connection was closed before we received a valid response",
+    "Read timeout on endpoint URL",
+    "Connect timeout on endpoint URL",
+]
+# Operations that are safe to run twice, besides the describe-, get-, list-
+# and head- reads. Only these are sent again after a transient error, which may
+# come after AWS already acted on the request. Anything else, like cloudformation
+# deploy or execute-change-set, is only retried when it was throttled
+IDEMPOTENT_OPERATIONS = {
+    "s3 ls",
+    "s3api put-object",
+    "s3api put-bucket-versioning",
+    "s3api upload-part",
+    "s3api abort-multipart-upload",
+    "s3api delete-objects",
+}
+# service -> (requests per second, burst), shared by every caller of one
+# AWSCommandRunner, services not listed aren't limited
+DEFAULT_RATE_LIMITS = {
+    "cloudformation": (5, 10),
+    "s3": (50, 100),
+    "sts": (5, 10),
+}
+
+
+def classify_error(error: ExecError):
+    # "throttling", "transient" or None when sending it again won't help
+    if error.exit_code not in [254, 255]:
+        # The CLI rejected the arguments or configuration, or was interrupted
+        return None
+    code = re.search(r"An error occurred \(([^)]+)\)", error.stderr or "")
+    if code is not None:
+        if code.group(1) in THROTTLING_ERRORS:
+            return "throttling"
+        if code.group(1) in TRANSIENT_ERRORS:
+            return "transient"
+        return None
+    if any(message in (error.stderr or "") for message in CONNECTION_ERRORS):
+        return "transient"
+    return None
+
+
+def idempotent(cmd):
+    if len(cmd) > 1 and cmd[1].startswith(("describe-", "get-", "list-", "head-")):
+        return True
+    return " ".join(cmd[:2]) in IDEMPOTENT_OPERATIONS
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        # Takes a token and returns how long to wait before using it, the
+        # bucket goes negative so callers queue up in the order they arrived
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
 class AWSCommandRunner:
+    # Full jitter exponential backoff between attempts
+    base_backoff = 0.5
+    max_backoff = 20.0
+
     argparse_group_name = "aws"
     argparse_group_description = "Verify that the account and credentials being used match the expected values set by these flags"
 
@@ -117,8 +505,19 @@ class AWSCommandRunner:
         region,
         account,
         user,
+        backend=None,
+        identity_cache: str | None = None,
+        identity_cache_ttl: int = 3600,
+        max_attempts: int = 5,
+        rate_limits: dict | None = None,
     ):
         self._command_runner = command_runner
+        self.max_attempts = max_attempts
+        self.rate_limits: dict = (
+            DEFAULT_RATE_LIMITS if rate_limits is None else rate_limits
+        )
+        self._rate_limit_buckets = {}
+        self._rate_limit_lock = threading.Lock()
         self.user: str = user
         self.account: str = account
         self.region: str = region
@@ -139,9 +538,15 @@ class AWSCommandRunner:
             # Can't test prodution credentials easily in a unit test, set them as the default
             self.ENDPOINT_URL = None
             self.AWS_CMD = "aws"
-        stdout, stderr = self.aws(["sts", "get-caller-identity"])
-        assert stderr == "", stderr
-        caller = json.loads(stdout)
+        # An optional factory like provisioner.botocore_backend.BotocoreBackend
+        # that can run some commands in-process, anything it doesn't handle
+        # still goes to the CLI. It's only made when the first command runs,
+        # since loading botocore takes longer than a cached identity check
+        self._backend_factory = backend
+        self._backend = None
+        self._backend_lock = threading.Lock()
+        self.identity_cache = identity_cache
+        caller = self.get_caller_identity(identity_cache, identity_cache_ttl)
         if caller["Account"] != account:
             actual_account = caller["Account"]
             raise Exception(
@@ -155,10 +560,623 @@ class AWSCommandRunner:
             )
         self.user: str = user
 
-    def aws(self, cmd):
-        return self._command_runner.exec(
-            [self.AWS_CMD, f"--region={self.region}"] + cmd
+    def written_files(self):
+        files = self._command_runner.written_files()
+        if self.identity_cache is not None:
+            files.append(self.identity_cache)
+        return files
+
+    @property
+    def backend(self):
+        if self._backend is None and self._backend_factory is not None:
+            with self._backend_lock:
+                if self._backend is None:
+                    self._backend = self._backend_factory(
+                        self._command_runner, self.region, self.ENDPOINT_URL
+                    )
+        return self._backend
+
+    def _identity_cache_key(self):
+        env = self._command_runner.env
+        # Hashing the secret too means rotated credentials are never matched
+        # against an identity cached for the old ones
+        return hashlib.sha256(
+            "\0".join(
+                [
+                    env["AWS_ACCESS_KEY_ID"],
+                    env["AWS_SECRET_ACCESS_KEY"],
+                    env.get("AWS_SESSION_TOKEN", ""),
+                    self.region,
+                    self.ENDPOINT_URL or "",
+                ]
+            ).encode("utf8")
+        ).hexdigest()
+
+    def _credential_expiry(self):
+        env = self._command_runner.env
+        for name in ["AWS_CREDENTIAL_EXPIRATION", "AWS_SESSION_EXPIRATION"]:
+            if env.get(name):
+                return datetime.datetime.fromisoformat(
+                    env[name].replace("Z", "+00:00")
+                ).timestamp()
+        return None
+
+    def get_caller_identity(self, cache: str | None = None, ttl: int = 3600):
+        with span("AWSCommandRunner.get_caller_identity", cached=False) as trace_span:
+            key_id = self._command_runner.env["AWS_ACCESS_KEY_ID"]
+            cached = {}
+            if cache is not None:
+                key = self._identity_cache_key()
+                now = time.time()
+                credential_expiry = self._credential_expiry()
+                if os.path.exists(cache):
+                    try:
+                        with open(cache, "r") as fp:
+                            cached = {
+                                k: v
+                                for k, v in json.load(fp).items()
+                                if now - v["fetched"] < ttl
+                                and (
+                                    v["credential_expiry"] is None
+                                    or v["credential_expiry"] > now
+                                )
+                                and "caller" in v
+                            }
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        # Corrupt or cut short, it's rewritten below
+                        self._command_runner.log(
+                            f"Ignoring the unreadable caller identity cache {cache}"
+                        )
+                        cached = {}
+                if key in cached:
+                    self._command_runner.log(
+                        f"Using the cached caller identity for {key_id} from {cache}"
+                    )
+                    trace_span.set_attribute("cached", True)
+                    return cached[key]["caller"]
+            self._command_runner.log(
+                f"Getting the caller identity for {key_id} from STS"
+            )
+            stdout, stderr = self.aws(["sts", "get-caller-identity"])
+            assert stderr == "", stderr
+            caller = json.loads(stdout)
+            if cache is not None and (
+                credential_expiry is None or credential_expiry > time.time()
+            ):
+                cached[key] = {
+                    "caller": caller,
+                    "fetched": time.time(),
+                    "credential_expiry": credential_expiry,
+                }
+                with replace_file(cache) as fp:
+                    json.dump(cached, fp)
+            return caller
+
+    def log(self, message, log_name=""):
+        self._command_runner.log(message, log_name)
+
+    def _rate_limit(self, cmd, log_name=""):
+        service = {"s3api": "s3"}.get(cmd[0], cmd[0])
+        if service not in self.rate_limits:
+            return 0.0
+        with self._rate_limit_lock:
+            if service not in self._rate_limit_buckets:
+                self._rate_limit_buckets[service] = TokenBucket(
+                    *self.rate_limits[service]
+                )
+        delay = self._rate_limit_buckets[service].reserve()
+        if delay:
+            self._command_runner.log(
+                f"Waiting {delay:.2f}s for the {service} rate limit", log_name
+            )
+        return delay
+
+    def _retry_delay(self, cmd, error, attempt, log_name=""):
+        kind = classify_error(error)
+        if kind is None or attempt >= self.max_attempts:
+            return None
+        if kind == "transient" and not idempotent(cmd):
+            # It may have gone through, and running it again could make a
+            # second change set or fail with "No updates are to be performed"
+            self._command_runner.log(
+                f"Transient error from {' '.join(cmd[:2])}, not retrying as it may have taken effect",
+                log_name,
+            )
+            return None
+        delay = random.uniform(
+            0, min(self.max_backoff, self.base_backoff * 2 ** (attempt - 1))
         )
+        self._command_runner.log(
+            f"{kind.capitalize()} error from {' '.join(cmd[:2])}, retrying in {delay:.2f}s (attempt {attempt + 1} of {self.max_attempts})",
+            log_name,
+        )
+        return delay
+
+    def aws(self, cmd, **kwargs):
+        log_name = kwargs.get("log_name", "")
+        with span(
+            "AWSCommandRunner.aws",
+            operation=" ".join(cmd[:2]),
+            log_name=log_name,
+        ) as trace_span:
+            if self.backend is not None and self.backend.handles(cmd):
+                trace_span.set_attribute("backend", type(self.backend).__name__)
+                run = self.backend.aws
+            else:
+                trace_span.set_attribute("backend", self.AWS_CMD)
+                if isinstance(self._command_runner, AsyncCommandRunner):
+                    run_command = self._command_runner.exec_blocking
+                else:
+                    run_command = self._command_runner.exec
+
+                def run(cmd, **kwargs):
+                    return run_command(
+                        [self.AWS_CMD, f"--region={self.region}"] + cmd, **kwargs
+                    )
+
+            attempt = 1
+            backoff = 0.0
+            while True:
+                time.sleep(self._rate_limit(cmd, log_name))
+                try:
+                    return run(cmd, **kwargs)
+                except ExecError as e:
+                    delay = self._retry_delay(cmd, e, attempt, log_name)
+                    if delay is None:
+                        raise
+                backoff += delay
+                trace_span.set_attribute("retries", attempt)
+                trace_span.set_attribute("backoff_seconds", backoff)
+                time.sleep(delay)
+                attempt += 1
+
+    async def aws_async(self, cmd, **kwargs):
+        if isinstance(self._command_runner, AsyncCommandRunner) and not (
+            self.backend is not None and self.backend.handles(cmd)
+        ):
+            log_name = kwargs.get("log_name", "")
+            with span(
+                "AWSCommandRunner.aws",
+                operation=" ".join(cmd[:2]),
+                log_name=log_name,
+                backend=self.AWS_CMD,
+            ) as trace_span:
+                attempt = 1
+                backoff = 0.0
+                while True:
+                    await asyncio.sleep(self._rate_limit(cmd, log_name))
+                    try:
+                        return await self._command_runner.exec(
+                            [self.AWS_CMD, f"--region={self.region}"] + cmd, **kwargs
+                        )
+                    except ExecError as e:
+                        delay = self._retry_delay(cmd, e, attempt, log_name)
+                        if delay is None:
+                            raise
+                    backoff += delay
+                    trace_span.set_attribute("retries", attempt)
+                    trace_span.set_attribute("backoff_seconds", backoff)
+                    await asyncio.sleep(delay)
+                    attempt += 1
+        # A plain CommandRunner and the backends block, so keep them off the event loop
+        return await asyncio.to_thread(self.aws, cmd, **kwargs)
+
+
+class Output:
+    # A parameter value taken from another stack's output, the stack is named
+    # without prefix or postfix and is deployed first when it's in the same batch
+    def __init__(self, stack: str, key: str):
+        self.stack = stack
+        self.key = key
+
+    def __repr__(self):
+        return f"Output({self.stack!r}, {self.key!r})"
+
+
+class Stack:
+    def __init__(
+        self,
+        name: str,
+        template_file: str,
+        parameters: dict | None = None,
+        depends_on: list | None = None,
+        capabilities: list | None = None,
+        artifacts: list | None = None,
+    ):
+        self.name = name
+        self.template_file = template_file
+        self.parameters: dict = parameters or {}
+        # Names (without prefix or postfix) of the stacks that must be deployed first
+        self.depends_on: list = depends_on or []
+        self.capabilities: list = capabilities or []
+        # Files and directories that cloudformation package reads, a change to
+        # any of them means the stack needs deploying again
+        if artifacts is None:
+            artifacts = [os.path.dirname(template_file) or "."]
+        self.artifacts: list = artifacts
+
+    def output_stacks(self):
+        return [
+            value.stack
+            for value in self.parameters.values()
+            if isinstance(value, Output)
+        ]
+
+    def __repr__(self):
+        return f"Stack({self.name!r})"
+
+
+# Statuses where the stack is running the template it was last successfully deployed with
+DEPLOYED_STATUSES = [
+    "CREATE_COMPLETE",
+    "UPDATE_COMPLETE",
+    "UPDATE_ROLLBACK_COMPLETE",
+    "IMPORT_COMPLETE",
+    "IMPORT_ROLLBACK_COMPLETE",
+]
+
+
+# Final statuses of the stack itself, anything else is still in progress
+STACK_SUCCEEDED_STATUSES = ["CREATE_COMPLETE", "UPDATE_COMPLETE", "IMPORT_COMPLETE"]
+STACK_FAILED_STATUSES = [
+    "CREATE_FAILED",
+    "ROLLBACK_COMPLETE",
+    "ROLLBACK_FAILED",
+    "UPDATE_FAILED",
+    "UPDATE_ROLLBACK_COMPLETE",
+    "UPDATE_ROLLBACK_FAILED",
+    "DELETE_COMPLETE",
+    "DELETE_FAILED",
+    "IMPORT_ROLLBACK_COMPLETE",
+    "IMPORT_ROLLBACK_FAILED",
+]
+
+
+class _WaitingStack:
+    def __init__(self, stack_name, after_event_id, interval):
+        self.stack_name = stack_name
+        self.after_event_id = after_event_id
+        self.interval = interval
+        self.next_poll = time.monotonic()
+        self.done = threading.Event()
+        self.status = None
+        self.error = None
+        self.context = contextvars.copy_context()
+
+
+class StackWaiter:
+    # Resources that change quickly are caught early, long running ones like
+    # CloudFront distributions are polled less and less often
+    min_interval = 2.0
+    max_interval = 30.0
+    backoff = 1.5
+
+    def __init__(
+        self,
+        aws_command_runner: AWSCommandRunner,
+        min_interval: float | None = None,
+        max_interval: float | None = None,
+    ):
+        self.aws_command_runner = aws_command_runner
+        if min_interval is not None:
+            self.min_interval = min_interval
+        if max_interval is not None:
+            self.max_interval = max_interval
+        self._condition = threading.Condition()
+        self._waiting: dict = {}
+        self._thread = None
+
+    def _events(self, stack_name, after_event_id):
+        # Events come newest first, so only read back as far as the last one seen
+        events = []
+        next_token = None
+        while True:
+            cmd = [
+                "cloudformation",
+                "describe-stack-events",
+                "--stack-name",
+                stack_name,
+                "--no-paginate",
+            ]
+            if next_token is not None:
+                cmd += ["--next-token", next_token]
+            stdout, _ = self.aws_command_runner.aws(cmd)
+            page = json.loads(stdout)
+            for event in page["StackEvents"]:
+                if event["EventId"] == after_event_id:
+                    return list(reversed(events))
+                events.append(event)
+            next_token = page.get("NextToken")
+            if after_event_id is None or not next_token:
+                return list(reversed(events))
+
+    def latest_event_id(self, stack_name):
+        try:
+            events = self._events(stack_name, None)
+        except ExecError as e:
+            # The stack doesn't exist yet. Anything else, like access denied,
+            # would have the wait take the stack's last deploy as this one's
+            if "(ValidationError)" in e.stderr and "does not exist" in e.stderr:
+                return None
+            raise
+        return events[-1]["EventId"] if events else None
+
+    def wait(self, stack_name, after_event_id=None):
+        with span("StackWaiter.wait", stack_name=stack_name) as trace_span:
+            status = self._wait(stack_name, after_event_id)
+            trace_span.set_attribute("status", status)
+            return status
+
+    def _wait(self, stack_name, after_event_id):
+        waiting = _WaitingStack(stack_name, after_event_id, self.min_interval)
+        with self._condition:
+            if stack_name in self._waiting:
+                raise Exception(f"Already waiting for stack '{stack_name}'")
+            self._waiting[stack_name] = waiting
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._poll_loop, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        waiting.done.wait()
+        if waiting.error is not None:
+            raise waiting.error
+        return waiting.status
+
+    def _poll_loop(self):
+        while True:
+            with self._condition:
+                if not self._waiting:
+                    self._thread = None
+                    return
+                now = time.monotonic()
+                due = [w for w in self._waiting.values() if w.next_poll <= now]
+                if not due:
+                    self._condition.wait(
+                        min(w.next_poll for w in self._waiting.values()) - now
+                    )
+                    continue
+            for waiting in due:
+                # Polls show up under the span of the thread waiting for the stack
+                waiting.context.run(self._poll, waiting)
+                if waiting.done.is_set():
+                    with self._condition:
+                        del self._waiting[waiting.stack_name]
+
+    def _poll(self, waiting):
+        log_name = f"[{waiting.stack_name}] "
+        try:
+            events = self._events(waiting.stack_name, waiting.after_event_id)
+        except Exception as e:
+            # Anything escaping here would stop the loop and leave every
+            # waiting thread blocked
+            waiting.error = e
+            waiting.done.set()
+            return
+        for event in events:
+            self.aws_command_runner.log(
+                " ".join(
+                    [
+                        str(event["Timestamp"]),
+                        event["ResourceStatus"],
+                        event["ResourceType"],
+                        event["LogicalResourceId"],
+                        event.get("ResourceStatusReason", ""),
+                    ]
+                ).rstrip(),
+                log_name,
+            )
+        if events:
+            waiting.after_event_id = events[-1]["EventId"]
+            waiting.interval = self.min_interval
+        else:
+            waiting.interval = min(waiting.interval * self.backoff, self.max_interval)
+        waiting.next_poll = time.monotonic() + waiting.interval
+        for event in events:
+            if (
+                event["ResourceType"] == "AWS::CloudFormation::Stack"
+                and event["LogicalResourceId"] == waiting.stack_name
+            ):
+                status = event["ResourceStatus"]
+                if status in STACK_SUCCEEDED_STATUSES:
+                    waiting.status = status
+                    waiting.done.set()
+                elif status in STACK_FAILED_STATUSES:
+                    waiting.status = status
+                    waiting.error = Exception(
+                        f"Stack '{waiting.stack_name}' finished with status {status}"
+                    )
+                    waiting.done.set()
+
+
+class BucketManager:
+    # The manager StackProvisioners use when they aren't given one, one per
+    # AWSCommandRunner, so a process checks each bucket once
+    _shared = weakref.WeakKeyDictionary()
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, aws_command_runner):
+        with cls._shared_lock:
+            if aws_command_runner not in cls._shared:
+                cls._shared[aws_command_runner] = cls(aws_command_runner)
+            return cls._shared[aws_command_runner]
+
+    def __init__(
+        self,
+        aws_command_runner: AWSCommandRunner,
+        cache: str | None = None,
+        cache_ttl: int = 24 * 3600,
+    ):
+        self.aws_command_runner = aws_command_runner
+        self.cache = cache
+        self.cache_ttl = cache_ttl
+        # Buckets already seen to exist with versioning enabled, shared by
+        # every StackProvisioner given this manager
+        self._verified = set()
+        self._lock = threading.Lock()
+
+    def _key(self, bucket):
+        return f"{self.aws_command_runner.account}/{self.aws_command_runner.region}/{bucket}"
+
+    def _read_cache(self):
+        if self.cache is None or not os.path.exists(self.cache):
+            return {}
+        now = time.time()
+        try:
+            with open(self.cache, "r") as fp:
+                return {
+                    k: v for k, v in json.load(fp).items() if now - v < self.cache_ttl
+                }
+        except (ValueError, TypeError, AttributeError):
+            # Corrupt or cut short, it's rewritten with the next verdict
+            self.aws_command_runner.log(
+                f"Ignoring the unreadable bucket cache {self.cache}"
+            )
+            return {}
+
+    def _write_cache(self, key):
+        if self.cache is None:
+            return
+        with self._lock:
+            cached = self._read_cache()
+            cached[key] = time.time()
+            with replace_file(self.cache) as fp:
+                json.dump(cached, fp)
+
+    def bucket_state(self, bucket):
+        try:
+            stdout, _ = self.aws_command_runner.aws(
+                ["s3api", "get-bucket-versioning", "--bucket", bucket]
+            )
+        except ExecError as e:
+            if "(NoSuchBucket)" in e.stderr:
+                return "missing"
+            # Access denied, throttling and the like say nothing about whether
+            # the bucket exists, so don't go creating it
+            raise
+        if stdout.strip() and json.loads(stdout).get("Status") == "Enabled":
+            return "versioned"
+        return "unversioned"
+
+    def ensure_versioned(self, bucket):
+        key = self._key(bucket)
+        with self._lock:
+            if key in self._verified:
+                return "cached"
+        if key in self._read_cache():
+            with self._lock:
+                self._verified.add(key)
+            return "cached"
+        state = self.bucket_state(bucket)
+        if state == "unversioned":
+            raise Exception(
+                f"The bucket '{bucket}' already exists, but versioning is not enabled"
+            )
+        if state == "missing":
+            self.create_versioned(bucket)
+            return "created"
+        print(
+            "The bucket already exists, but bucket versioning is enabled, so we can continue."
+        )
+        self._remember(key)
+        return "exists"
+
+    def create_versioned(self, bucket):
+        try:
+            self.aws_command_runner.aws(
+                [
+                    "s3api",
+                    "create-bucket",
+                    "--bucket",
+                    bucket,
+                    "--create-bucket-configuration",
+                    f"LocationConstraint={self.aws_command_runner.region}",
+                ]
+            )
+        except ExecError as e:
+            # Another run got there first
+            if "(BucketAlreadyOwnedByYou)" not in e.stderr:
+                raise
+        self.aws_command_runner.aws(
+            [
+                "s3api",
+                "put-bucket-versioning",
+                "--bucket",
+                bucket,
+                "--versioning-configuration",
+                "Status=Enabled",
+            ]
+        )
+        print("Created the bucket and enabled versioning.")
+        self._remember(self._key(bucket))
+
+    def _remember(self, key):
+        with self._lock:
+            self._verified.add(key)
+        self._write_cache(key)
+
+    def ensure_versioned_buckets(self, buckets, max_workers: int = 4):
+        with span("BucketManager.ensure_versioned_buckets", buckets=len(buckets)):
+            with concurrent_futures.ThreadPoolExecutor(
+                max_workers=max_workers
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        contextvars.copy_context().run, self.ensure_versioned, bucket
+                    )
+                    for bucket in buckets
+                ]
+            return {bucket: future.result() for bucket, future in zip(buckets, futures)}
+
+
+class Journal:
+    # An append-only JSON Lines record of each step a StackProvisioner
+    # completes, so a run that dies part way through can be resumed
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.records: list = []
+        self._lock = threading.Lock()
+        content = ""
+        if resume and os.path.exists(path):
+            with open(path, "r") as fp:
+                content = fp.read()
+            for line in content.splitlines():
+                try:
+                    self.records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # The run died while writing this line
+                    continue
+        self._file = open(path, "a" if resume else "w")
+        if content and not content.endswith("\n"):
+            self._file.write("\n")
+
+    def append(self, step: str, **record):
+        record = {"step": step, "time": time.time(), **record}
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self.records.append(record)
+
+    def last(self, step: str | None = None, **match):
+        with self._lock:
+            for record in reversed(self.records):
+                if (step is None or record["step"] == step) and all(
+                    record.get(key) == value for key, value in match.items()
+                ):
+                    return record
+        return None
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class DeployError(Exception):
+    def __init__(self, failed, skipped, *k, **p):
+        super().__init__(*k, **p)
+        self.failed = failed
+        self.skipped = skipped
 
 
 class StackProvisioner:
@@ -184,6 +1202,25 @@ class StackProvisioner:
             default="",
             help="string to add to the end of any resources which share a global AWS namespace (like S3 bucket names, Cognito domain names etc) to help make them unique e.g. -zyi3uv",
         )
+        group.add_argument(
+            "--journal",
+            help="file to record each completed step in, so an interrupted run can be resumed",
+        )
+        group.add_argument(
+            "--resume",
+            action="store_true",
+            help="carry on from the steps recorded in --journal instead of starting again",
+        )
+        group.add_argument(
+            "--plan",
+            dest="plan_file",
+            help="only read from AWS and write what would be created, uploaded and deployed to this file",
+        )
+        group.add_argument(
+            "--apply",
+            dest="apply_file",
+            help="deploy the plan written by --plan, without reading everything again",
+        )
         return group
 
     def __init__(
@@ -193,9 +1230,25 @@ class StackProvisioner:
         stack_name_prefix: str = "",
         global_postfix: str = "",
         stacks: list | None = None,
+        waiter: StackWaiter | None = None,
+        bucket_manager: BucketManager | None = None,
+        journal: str | None = None,
+        resume: bool = False,
+        plan_file: str | None = None,
+        apply_file: str | None = None,
     ):
+        if resume and journal is None:
+            raise ValueError("resume needs a journal to resume from")
+        if plan_file is not None and apply_file is not None:
+            raise ValueError("plan_file and apply_file can't be used together")
+        if plan_file is not None and journal is not None:
+            raise ValueError("A plan doesn't change anything, so has no journal")
         self.stacks: list = stacks or []
         self.aws_command_runner = aws_command_runner
+        # Pass the same one to later StackProvisioners to skip checking the bucket again
+        self.bucket_manager = bucket_manager or BucketManager.shared(aws_command_runner)
+        # Shared by every stack being deployed, so one loop polls them all
+        self.waiter = waiter or StackWaiter(aws_command_runner)
         self.cloudformation_bucket = (
             cloudformation_bucket  # we'll leave the user to add the global_postfix
         )
@@ -211,66 +1264,784 @@ class StackProvisioner:
                     f"Unexpected character '{c}' in global_prefix, please stick to lowercase letters, numbers and -"
                 )
         self.global_postfix = global_postfix
-        self.ensure_versioned_bucket_exists_and_create_if_not(
-            self.cloudformation_bucket + global_postfix
-        )
-        self.start_stack_status = self.describe_stacks(
-            [stack_name + self.global_postfix for stack_name in self.stacks]
-        )
+        # Every stack in the region by full name, loaded by one describe-stacks
+        # and only described again once this provisioner deploys a stack in it
+        self._stack_info = None
+        self._stale_stacks = set()
+        self._stack_info_lock = threading.Lock()
+        self.journal = None if journal is None else Journal(journal, resume)
+        # A dry run only reads, plan() writes what deploying would do to
+        # plan_file and apply() does it later from apply_file
+        self.plan_file = plan_file
+        self.apply_file = apply_file
+        self.applying = None
+        bucket = self.cloudformation_bucket + global_postfix
+        with span("StackProvisioner.__init__"):
+            if apply_file is not None:
+                with open(apply_file, "r") as fp:
+                    self.applying = json.load(fp)
+                self._check_plan(self.applying)
+                # Everything else was read when the plan was made
+                self.bucket_state = self.applying["bucket"]
+                self.start_stack_status = self.applying["snapshot"]
+                return
+            if plan_file is not None:
+                # Nothing is created, so the bucket and stacks are read side by side
+                with concurrent_futures.ThreadPoolExecutor(max_workers=2) as executor:
+                    state = executor.submit(
+                        contextvars.copy_context().run,
+                        self.bucket_manager.bucket_state,
+                        bucket,
+                    )
+                    if self.stacks:
+                        self._stack_info = self._describe_all_stacks()
+                self.bucket_state = state.result()
+            else:
+                self.ensure_versioned_bucket_exists_and_create_if_not(bucket)
+                self.bucket_state = "versioned"
+                if self.stacks:
+                    self._stack_info = self._describe_all_stacks()
+            stack_names = {self.full_stack_name(stack.name) for stack in self.stacks}
+            self.start_stack_status = {
+                name: info
+                for name, info in (self._stack_info or {}).items()
+                if name in stack_names
+            }
 
-    def describe_stacks(self, stack_names):
-        return None
-        # cmd = [
-        #     "cloudformation",
-        #     "describe-stacks",
-        # ]
-        # for stack_name in stack_names:
-        #     cmd += [
-        #         "--stack-name",
-        #         stack_name,
-        #     ]
-        # stdout, _ = self.aws_command_runner.aws(cmd)
-        # res = json.loads(stdout)
-        # print(stack_names, res)
-        # return res
+    def full_stack_name(self, name):
+        return self.stack_name_prefix + name + self.global_postfix
 
-    def ensure_versioned_bucket_exists_and_create_if_not(self, bucket):
-        try:
+    def _plan_target(self):
+        return {
+            "region": self.aws_command_runner.region,
+            "account": self.aws_command_runner.account,
+            "cloudformation_bucket": self.cloudformation_bucket + self.global_postfix,
+            "stack_name_prefix": self.stack_name_prefix,
+            "global_postfix": self.global_postfix,
+        }
+
+    def _check_plan(self, plan):
+        for key, value in self._plan_target().items():
+            if plan.get(key) != value:
+                raise Exception(
+                    f"The plan in '{self.apply_file}' has {key} '{plan.get(key)}' but this provisioner has '{value}'"
+                )
+
+    def _check_not_planning(self):
+        if self.plan_file is not None:
+            raise Exception(
+                "This provisioner is only planning, apply the plan to change anything"
+            )
+
+    def _describe_all_stacks(self):
+        with span("StackProvisioner.describe_stacks"):
+            # describe-stacks only takes one --stack-name, so list every live stack
+            # in the region instead (the CLI follows NextToken for us)
             stdout, _ = self.aws_command_runner.aws(
-                ["s3api", "get-bucket-versioning", "--bucket", bucket]
+                ["cloudformation", "describe-stacks"]
             )
-            if stdout.strip() and json.loads(stdout)["Status"] == "Enabled":
-                print(
-                    "The bucket already exists, but bucket versioning is enabled, so we can continue."
-                )
+            return {
+                stack["StackName"]: {
+                    "status": stack["StackStatus"],
+                    "parameters": {
+                        p["ParameterKey"]: p.get("ParameterValue")
+                        for p in stack.get("Parameters", [])
+                    },
+                    "outputs": {
+                        o["OutputKey"]: o["OutputValue"]
+                        for o in stack.get("Outputs", [])
+                    },
+                }
+                for stack in (json.loads(stdout)["Stacks"] if stdout.strip() else [])
+            }
+
+    def describe_stacks(self, stack_names: list | None = None):
+        if stack_names is not None and not stack_names:
+            return {}
+        stacks = self._describe_all_stacks()
+        if stack_names is not None:
+            stack_names = set(stack_names)
+            return {name: info for name, info in stacks.items() if name in stack_names}
+        # Keep the ones that belong to this provisioner
+        return {
+            name: info
+            for name, info in stacks.items()
+            if name.startswith(self.stack_name_prefix)
+            and name.endswith(self.global_postfix)
+        }
+
+    def stack_info(self, stack_name):
+        with self._stack_info_lock:
+            if self._stack_info is None or stack_name in self._stale_stacks:
+                # Every stale stack is refreshed by the same call
+                self._stack_info = self._describe_all_stacks()
+                self._stale_stacks.clear()
+            return self._stack_info.get(stack_name)
+
+    def invalidate(self, stack_name):
+        with self._stack_info_lock:
+            self._stale_stacks.add(stack_name)
+
+    def resolve_parameters(self, stack: Stack):
+        parameters = {}
+        for key, value in stack.parameters.items():
+            if isinstance(value, Output):
+                stack_name = self.full_stack_name(value.stack)
+                outputs = (self.stack_info(stack_name) or {}).get("outputs", {})
+                if value.key not in outputs:
+                    raise Exception(f"Stack '{stack_name}' has no output '{value.key}'")
+                value = outputs[value.key]
+            parameters[key] = value
+        return parameters
+
+    def ensure_versioned_bucket_exists_and_create_if_not(self, bucket):
+        with span(
+            "StackProvisioner.ensure_versioned_bucket_exists_and_create_if_not",
+            bucket=bucket,
+        ):
+            self._check_not_planning()
+            if self.journal is not None and self.journal.last("bucket", bucket=bucket):
+                return "cached"
+            state = self.bucket_manager.ensure_versioned(bucket)
+            if self.journal is not None:
+                self.journal.append("bucket", bucket=bucket)
+            return state
+
+    def content_hash(self, stack: Stack, parameters: dict | None = None):
+        if parameters is None:
+            parameters = self.resolve_parameters(stack)
+        h = hashlib.sha256()
+        h.update(
+            json.dumps(
+                [
+                    self.full_stack_name(stack.name),
+                    stack.template_file,
+                    parameters,
+                    stack.capabilities,
+                ],
+                sort_keys=True,
+            ).encode("utf8")
+        )
+        paths = []
+        written = None
+        for artifact in stack.artifacts:
+            if os.path.isdir(artifact):
+                if written is None:
+                    written = self.written_files()
+                paths += [
+                    path
+                    for _, path in walk_files(artifact)
+                    if os.path.abspath(path) not in written
+                ]
             else:
-                print(stdout)
-                raise Exception(
-                    f"The bucket '{bucket}' already exists, but versioning is not enabled"
-                )
-        except ExecError:
-            # Assume the bucket does not exist
-            self.aws_command_runner.aws(
+                paths.append(artifact)
+        for path in paths:
+            h.update(f"\0{path}\0{os.path.getsize(path)}\0".encode("utf8"))
+            with open(path, "rb") as fp:
+                for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+                    h.update(chunk)
+        return h.hexdigest()
+
+    def written_files(self):
+        # The log, trace, journal, caches and plan, which change on every run,
+        # so a directory holding them still hashes the same
+        files = self.aws_command_runner.written_files() + [
+            self.bucket_manager.cache,
+            self.plan_file,
+            self.apply_file,
+        ]
+        if self.journal is not None:
+            files.append(self.journal.path)
+        return {os.path.abspath(f) for f in files if f is not None}
+
+    def deployed_content_hash(self, stack_name):
+        # The hash of the last successful deploy is kept as the metadata of an
+        # empty object next to the stack's artifacts in the versioned bucket
+        try:
+            stdout, _ = self.aws_command_runner.aws(
                 [
                     "s3api",
-                    "create-bucket",
+                    "head-object",
                     "--bucket",
-                    bucket,
-                    "--create-bucket-configuration",
-                    f"LocationConstraint={self.aws_command_runner.region}",
+                    self.cloudformation_bucket + self.global_postfix,
+                    "--key",
+                    f"{stack_name}/content-hash",
                 ]
             )
+        except ExecError:
+            return None
+        return json.loads(stdout).get("Metadata", {}).get("content-hash")
+
+    def unchanged(self, stack: Stack, content_hash=None, parameters=None):
+        stack_name = self.full_stack_name(stack.name)
+        snapshot = (self.start_stack_status or {}).get(stack_name)
+        if snapshot is None or snapshot["status"] not in DEPLOYED_STATUSES:
+            return False
+        # The snapshot already has the deployed parameters, so a changed one
+        # doesn't need the content hash fetching
+        if parameters is None:
+            parameters = self.resolve_parameters(stack)
+        for key, value in parameters.items():
+            # NoEcho parameters come back masked
+            if snapshot["parameters"].get(key) not in [str(value), "****"]:
+                return False
+        if content_hash is None:
+            content_hash = self.content_hash(stack, parameters)
+        return self.deployed_content_hash(stack_name) == content_hash
+
+    def create_change_set(self, stack: Stack):
+        stack_name = self.full_stack_name(stack.name)
+        with span("StackProvisioner.create_change_set", stack_name=stack_name):
+            self._check_not_planning()
+            parameters = self.resolve_parameters(stack)
+            content_hash = self.content_hash(stack, parameters)
+            resumed = self.resume_stack(stack_name, content_hash)
+            if resumed is not None:
+                return resumed or None
+            if self.unchanged(stack, content_hash, parameters):
+                print(
+                    f"Stack '{stack_name}' is unchanged, skipping package and deploy."
+                )
+                return None
+            return self._package_and_create_change_set(stack, parameters, content_hash)
+
+    def _package_and_create_change_set(self, stack: Stack, parameters, content_hash):
+        stack_name = self.full_stack_name(stack.name)
+        bucket = self.cloudformation_bucket + self.global_postfix
+        log_name = f"[{stack_name}] "
+        with tempfile.TemporaryDirectory() as tmp:
+            packaged_template_file = os.path.join(tmp, "packaged.yml")
             self.aws_command_runner.aws(
                 [
-                    "s3api",
-                    "put-bucket-versioning",
-                    "--bucket",
+                    "cloudformation",
+                    "package",
+                    "--template-file",
+                    stack.template_file,
+                    "--s3-bucket",
                     bucket,
-                    "--versioning-configuration",
-                    "Status=Enabled",
+                    "--s3-prefix",
+                    stack_name,
+                    "--output-template-file",
+                    packaged_template_file,
+                ],
+                log_name=log_name,
+                # Every upload is reported, and all of it is in the log anyway
+                max_output=64 * 1024,
+            )
+            cmd = [
+                "cloudformation",
+                "deploy",
+                "--template-file",
+                packaged_template_file,
+                "--stack-name",
+                stack_name,
+                "--s3-bucket",
+                bucket,
+                "--s3-prefix",
+                stack_name,
+                "--no-execute-changeset",
+                "--no-fail-on-empty-changeset",
+            ]
+            if parameters:
+                cmd += ["--parameter-overrides"] + [
+                    f"{key}={value}" for key, value in parameters.items()
                 ]
+            if stack.capabilities:
+                cmd += ["--capabilities"] + stack.capabilities
+            # Only create the change set, the waiter watches it execute rather
+            # than holding a CLI process open for every stack
+            stdout, _ = self.aws_command_runner.aws(cmd, log_name=log_name)
+        change_set = re.search(r"--change-set-name (\S+)", stdout)
+        # No change set when CloudFormation found nothing to change, but the
+        # content hash is still recorded so the next run skips the stack
+        created = {
+            "content_hash": content_hash,
+            "change_set": change_set.group(1) if change_set else None,
+        }
+        if self.journal is not None:
+            self.journal.append("change_set", stack=stack_name, **created)
+        return created
+
+    def resume_stack(self, stack_name, content_hash):
+        # None when there's nothing to resume, False when the interrupted run
+        # finished the stack, otherwise the change set to carry on with
+        if self.journal is None:
+            return None
+        record = self.journal.last(stack=stack_name)
+        if record is None or record.get("content_hash") != content_hash:
+            return None
+        created = {"content_hash": content_hash, "change_set": record["change_set"]}
+        if record["step"] == "deployed":
+            print(
+                f"Stack '{stack_name}' was deployed by the interrupted run, skipping."
+            )
+            return False
+        if record["step"] not in ["change_set", "executing"]:
+            return None
+        if record["change_set"] is None:
+            return created
+        status = self.change_set_status(
+            record["change_set"], log_name=f"[{stack_name}] "
+        )
+        if status == "AVAILABLE":
+            print(f"Resuming stack '{stack_name}' from its change set.")
+            return created
+        if record["step"] == "executing":
+            # CloudFormation deletes a change set once it's executed, so the
+            # stack is still running or finished with nobody watching, either
+            # way the waiter reads its events from where it started
+            print(f"Resuming the wait for stack '{stack_name}'.")
+            return {**created, "after_event_id": record["after_event_id"]}
+        return None
+
+    def change_set_status(self, change_set, log_name=""):
+        try:
+            stdout, _ = self.aws_command_runner.aws(
+                [
+                    "cloudformation",
+                    "describe-change-set",
+                    "--change-set-name",
+                    change_set,
+                ],
+                log_name=log_name,
+            )
+        except ExecError:
+            # Deleted, or its stack was
+            return None
+        return json.loads(stdout).get("ExecutionStatus") if stdout.strip() else None
+
+    def describe_change_set(self, change_set, log_name=""):
+        stdout, _ = self.aws_command_runner.aws(
+            ["cloudformation", "describe-change-set", "--change-set-name", change_set],
+            log_name=log_name,
+        )
+        return [
+            change["ResourceChange"]
+            for change in (json.loads(stdout) if stdout.strip() else {}).get(
+                "Changes", []
+            )
+            if "ResourceChange" in change
+        ]
+
+    def execute_change_set(self, stack: Stack, created):
+        self._check_not_planning()
+        stack_name = self.full_stack_name(stack.name)
+        log_name = f"[{stack_name}] "
+        if created["change_set"] is not None:
+            if "after_event_id" in created:
+                # Executed by the interrupted run
+                after_event_id = created["after_event_id"]
+            else:
+                after_event_id = self.waiter.latest_event_id(stack_name)
+                if self.journal is not None:
+                    self.journal.append(
+                        "executing",
+                        stack=stack_name,
+                        content_hash=created["content_hash"],
+                        change_set=created["change_set"],
+                        after_event_id=after_event_id,
+                    )
+                self.aws_command_runner.aws(
+                    [
+                        "cloudformation",
+                        "execute-change-set",
+                        "--change-set-name",
+                        created["change_set"],
+                    ],
+                    log_name=log_name,
+                )
+            try:
+                self.waiter.wait(stack_name, after_event_id)
+            except Exception:
+                if self.journal is not None:
+                    # So a resumed run creates a new change set
+                    self.journal.append(
+                        "failed", stack=stack_name, change_set=created["change_set"]
+                    )
+                raise
+            # Its outputs may have changed for the stacks that use them
+            self.invalidate(stack_name)
+        self.aws_command_runner.aws(
+            [
+                "s3api",
+                "put-object",
+                "--bucket",
+                self.cloudformation_bucket + self.global_postfix,
+                "--key",
+                f"{stack_name}/content-hash",
+                "--metadata",
+                f"content-hash={created['content_hash']}",
+            ],
+            log_name=log_name,
+        )
+        if self.journal is not None:
+            self.journal.append(
+                "deployed",
+                stack=stack_name,
+                content_hash=created["content_hash"],
+                change_set=created["change_set"],
+            )
+
+    def package_upload_deploy_wait(self, stack: Stack):
+        stack_name = self.full_stack_name(stack.name)
+        with span(
+            "StackProvisioner.package_upload_deploy_wait", stack_name=stack_name
+        ) as trace_span:
+            created = self.create_change_set(stack)
+            if created is None:
+                trace_span.set_attribute("skipped", True)
+                return False
+            self.execute_change_set(stack, created)
+            return True
+
+    def preview_change_sets(self, stacks: list | None = None, max_workers: int = 4):
+        if stacks is None:
+            stacks = self.stacks
+        layers = self.deployment_order(stacks)
+        dependencies = self._dependencies(stacks)
+        created = {}
+        # Stacks with a change set to execute, a stack depending on one can't
+        # be previewed until it's deployed, as an ImportValue or Output it
+        # uses may not exist or may change
+        changing = set()
+        with span("StackProvisioner.preview_change_sets", stacks=len(stacks)):
+            for i, layer in enumerate(layers):
+                ready = [s for s in layer if not dependencies[s.name] & changing]
+                waiting = [s for s in layer if dependencies[s.name] & changing]
+                created.update(
+                    self._preview_layer(
+                        ready,
+                        max_workers,
+                        [s.name for following in layers[i + 1 :] for s in following],
+                    )
+                )
+                changing.update(
+                    name
+                    for name, c in created.items()
+                    if c is not None and c["change_set"] is not None
+                )
+                for stack in waiting:
+                    changing.add(stack.name)
+                    print(
+                        f"Stack '{self.full_stack_name(stack.name)}' is previewed once the stacks it depends on are deployed."
+                    )
+        return created
+
+    def _preview_layer(self, layer, max_workers, later):
+        def create(stack):
+            created = self.create_change_set(stack)
+            if created is not None and created["change_set"] is not None:
+                created["changes"] = self.describe_change_set(
+                    created["change_set"],
+                    log_name=f"[{self.full_stack_name(stack.name)}] ",
+                )
+            return created
+
+        # A layer's change sets are created and described side by side
+        with concurrent_futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                stack.name: executor.submit(
+                    contextvars.copy_context().run, create, stack
+                )
+                for stack in layer
+            }
+        failed = {
+            name: future.exception()
+            for name, future in futures.items()
+            if future.exception() is not None
+        }
+        if failed:
+            raise DeployError(
+                failed,
+                later,
+                f"Failed to create change sets for stacks: {', '.join(sorted(failed))}",
+            )
+        created = {name: future.result() for name, future in futures.items()}
+        for stack in layer:
+            stack_name = self.full_stack_name(stack.name)
+            if created[stack.name] is None:
+                continue
+            if created[stack.name]["change_set"] is None:
+                print(f"No changes to stack '{stack_name}'.")
+                continue
+            print(f"Changes to stack '{stack_name}':")
+            for change in created[stack.name]["changes"]:
+                replacement = change.get("Replacement")
+                print(
+                    f"  {change.get('Action', ''):<8}{change.get('ResourceType', ''):<40}{change.get('LogicalResourceId', '')}"
+                    + (
+                        f" (replacement: {replacement})"
+                        if replacement in ["True", "Conditional"]
+                        else ""
+                    )
+                )
+        return created
+
+    def _dependencies(self, stacks):
+        names = {stack.name for stack in stacks}
+        # Stacks outside this batch are expected to be deployed already
+        return {
+            stack.name: set(stack.depends_on)
+            | {name for name in stack.output_stacks() if name in names}
+            for stack in stacks
+        }
+
+    def deployment_order(self, stacks):
+        by_name = {}
+        for stack in stacks:
+            if stack.name in by_name:
+                raise ValueError(f"Stack '{stack.name}' is defined more than once")
+            by_name[stack.name] = stack
+        for stack in stacks:
+            for dependency in stack.depends_on:
+                if dependency not in by_name:
+                    raise ValueError(
+                        f"Stack '{stack.name}' depends on unknown stack '{dependency}'"
+                    )
+        # Kahn's algorithm, grouping stacks into layers that can run side by side
+        remaining = self._dependencies(stacks)
+        layers = []
+        while remaining:
+            layer = [name for name, deps in remaining.items() if not deps]
+            if not layer:
+                raise ValueError(
+                    f"Circular dependency between stacks: {', '.join(sorted(remaining))}"
+                )
+            for name in layer:
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(layer)
+            layers.append([by_name[name] for name in layer])
+        return layers
+
+    def deploy_stacks(
+        self,
+        stacks: list | None = None,
+        max_workers: int = 4,
+        preview: bool = False,
+    ):
+        if stacks is None:
+            stacks = self.stacks
+        # Validates the graph before anything is deployed
+        layers = self.deployment_order(stacks)
+        with span("StackProvisioner.deploy_stacks", stacks=len(stacks)):
+            if preview:
+                return self._preview_and_deploy(layers, max_workers)
+            return self._deploy_in_order(
+                stacks, self.package_upload_deploy_wait, max_workers
             )
-            print("Created the bucket and enabled versioning.")
+
+    def _preview_and_deploy(self, layers, max_workers):
+        # Each layer is previewed once the layers before it are deployed, so
+        # its change sets use the outputs those stacks have now
+        deployed = []
+        for i, layer in enumerate(layers):
+            later = [s.name for following in layers[i + 1 :] for s in following]
+            created = self._preview_layer(layer, max_workers, later)
+            with concurrent_futures.ThreadPoolExecutor(
+                max_workers=max_workers
+            ) as executor:
+                futures = {
+                    stack.name: executor.submit(
+                        contextvars.copy_context().run,
+                        self.execute_change_set,
+                        stack,
+                        created[stack.name],
+                    )
+                    for stack in layer
+                    if created[stack.name] is not None
+                }
+            failed = {
+                name: future.exception()
+                for name, future in futures.items()
+                if future.exception() is not None
+            }
+            if failed:
+                raise DeployError(
+                    failed,
+                    later,
+                    f"Failed to deploy stacks: {', '.join(sorted(failed))}"
+                    + (f" (skipped: {', '.join(sorted(later))})" if later else ""),
+                )
+            deployed += [stack.name for stack in layer]
+        return deployed
+
+    def _deploy_in_order(self, stacks, deploy, max_workers):
+        dependencies = self._dependencies(stacks)
+        waiting = {stack.name: stack for stack in stacks}
+        deployed = []
+        failed = {}
+        skipped = []
+        with concurrent_futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            running = {}
+            while waiting or running:
+                # A stack starts as soon as everything it depends on has
+                # finished, rather than waiting for the whole layer
+                for name, stack in list(waiting.items()):
+                    if any(d in failed or d in skipped for d in dependencies[name]):
+                        skipped.append(name)
+                        del waiting[name]
+                    elif all(d in deployed for d in dependencies[name]):
+                        # Each stack's spans nest under this one
+                        running[
+                            executor.submit(
+                                contextvars.copy_context().run,
+                                deploy,
+                                stack,
+                            )
+                        ] = name
+                        del waiting[name]
+                if not running:
+                    continue
+                done, _ = concurrent_futures.wait(
+                    running, return_when=concurrent_futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        deployed.append(name)
+                    else:
+                        failed[name] = error
+        if failed:
+            raise DeployError(
+                failed,
+                skipped,
+                f"Failed to deploy stacks: {', '.join(sorted(failed))}"
+                + (f" (skipped: {', '.join(sorted(skipped))})" if skipped else ""),
+            )
+        return deployed
+
+    def plan(self, stacks: list | None = None, max_workers: int = 4):
+        if stacks is None:
+            stacks = self.stacks
+        bucket = self.cloudformation_bucket + self.global_postfix
+        if self.bucket_state == "unversioned":
+            raise Exception(
+                f"The bucket '{bucket}' already exists, but versioning is not enabled"
+            )
+        planned = {}
+        with span("StackProvisioner.plan", stacks=len(stacks)):
+            # A layer's stacks are hashed and compared side by side, each
+            # layer after the one it takes outputs from
+            for layer in self.deployment_order(stacks):
+                with concurrent_futures.ThreadPoolExecutor(
+                    max_workers=max_workers
+                ) as executor:
+                    futures = {
+                        stack.name: executor.submit(
+                            contextvars.copy_context().run,
+                            self._plan_stack,
+                            stack,
+                            planned,
+                        )
+                        for stack in layer
+                    }
+                planned.update(
+                    {name: future.result() for name, future in futures.items()}
+                )
+        plan = {
+            **self._plan_target(),
+            "bucket": self.bucket_state,
+            "snapshot": self.start_stack_status,
+            "stacks": planned,
+        }
+        if self.bucket_state == "missing":
+            print(f"Bucket '{bucket}' will be created with versioning enabled.")
+        for stack in stacks:
+            entry = planned[stack.name]
+            if entry["action"] == "unchanged":
+                print(f"Stack '{entry['stack_name']}' is unchanged.")
+                continue
+            print(
+                f"Stack '{entry['stack_name']}' will be {entry['action']}d from {', '.join(stack.artifacts) or stack.template_file}"
+                + (
+                    ""
+                    if entry["parameters"] is not None
+                    else ", with outputs from stacks deployed first"
+                )
+                + "."
+            )
+        if self.plan_file is not None:
+            # apply() deploys with the resolved parameters, NoEcho ones
+            # included, so only the owner can read them
+            fd = os.open(self.plan_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fd, "w") as fp:
+                json.dump(plan, fp, indent=2)
+        return plan
+
+    def _plan_stack(self, stack: Stack, planned):
+        stack_name = self.full_stack_name(stack.name)
+        entry = {
+            "stack_name": stack_name,
+            "action": "create"
+            if stack_name not in self.start_stack_status
+            else "update",
+            "content_hash": None,
+            "parameters": None,
+        }
+        if any(
+            planned[name]["action"] != "unchanged"
+            for name in stack.output_stacks()
+            if name in planned
+        ):
+            # Its parameters aren't known until those stacks are deployed
+            return entry
+        parameters = self.resolve_parameters(stack)
+        entry["parameters"] = parameters
+        entry["content_hash"] = self.content_hash(stack, parameters)
+        # Nothing can be deployed if the bucket holding the content hashes isn't there
+        if self.bucket_state != "missing" and self.unchanged(
+            stack, entry["content_hash"], parameters
+        ):
+            entry["action"] = "unchanged"
+        return entry
+
+    def apply(self, max_workers: int = 4):
+        if self.applying is None:
+            raise Exception("apply() needs a provisioner made with an apply_file")
+        planned = self.applying["stacks"]
+        missing = sorted(set(planned) - {stack.name for stack in self.stacks})
+        if missing:
+            raise Exception(
+                f"The plan has stacks that weren't given: {', '.join(missing)}"
+            )
+        stacks = [stack for stack in self.stacks if stack.name in planned]
+        # Validates the graph before anything is deployed
+        self.deployment_order(stacks)
+        # The files deployed must be the ones planned, stacks taking outputs
+        # from changed stacks are hashed when they're deployed instead
+        for stack in stacks:
+            entry = planned[stack.name]
+            if entry["parameters"] is not None and entry[
+                "content_hash"
+            ] != self.content_hash(stack, entry["parameters"]):
+                raise Exception(
+                    f"The plan is stale, stack '{entry['stack_name']}' changed since it was made, re-run --plan"
+                )
+
+        def deploy(stack):
+            entry = planned[stack.name]
+            if entry["action"] == "unchanged":
+                return False
+            with span("StackProvisioner.apply_stack", stack_name=entry["stack_name"]):
+                parameters = entry["parameters"]
+                content_hash = entry["content_hash"]
+                if parameters is None:
+                    parameters = self.resolve_parameters(stack)
+                    content_hash = self.content_hash(stack, parameters)
+                created = self._package_and_create_change_set(
+                    stack, parameters, content_hash
+                )
+                self.execute_change_set(stack, created)
+                return True
+
+        with span("StackProvisioner.apply", stacks=len(stacks)):
+            if self.applying["bucket"] == "missing":
+                self.bucket_manager.create_versioned(
+                    self.cloudformation_bucket + self.global_postfix
+                )
+            return self._deploy_in_order(stacks, deploy, max_workers)
 
 
 def parse_args(parser, group_classes, args):
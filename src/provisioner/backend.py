@@ -0,0 +1,58 @@
+import shlex
+import time
+
+from . import ExecError
+
+
+class Unsupported(Exception):
+    # A command a backend can't run itself
+    pass
+
+
+class Backend:
+    # The parts of an in-process backend for AWSCommandRunner that make it look
+    # like the CLI ran: the command, output and exit code in the log, the
+    # on_stdout/on_stderr callbacks and a trace record, like CommandRunner.exec
+    name = "backend"
+
+    def __init__(self, command_runner):
+        self._command_runner = command_runner
+
+    def _log_command(self, cmd, log_name):
+        self._command_runner.log(
+            f"{self.name} % {' '.join([shlex.quote(term) for term in cmd])}",
+            log_name,
+        )
+        return time.monotonic()
+
+    def _lines(self, text, log_name, on_line):
+        for line in text.splitlines(keepends=True):
+            self._command_runner.log(line.rstrip("\n"), log_name)
+            if on_line is not None:
+                on_line(line)
+
+    def _trace(self, cmd, start, exit_code, stdout, stderr, log_name):
+        self._command_runner._trace(
+            [self.name] + cmd,
+            self._command_runner.cwd,
+            log_name,
+            start,
+            exit_code,
+            len(stdout.encode("utf8")),
+            len(stderr.encode("utf8")),
+        )
+
+    def _return(self, cmd, start, stdout, log_name, on_stdout, max_output):
+        self._lines(stdout, log_name, on_stdout)
+        self._trace(cmd, start, 0, stdout, "", log_name)
+        if max_output is not None:
+            stdout = stdout[-max_output:] if max_output > 0 else ""
+        return stdout, ""
+
+    def _raise(self, cmd, start, stderr, log_name, on_stderr):
+        # Matches the exit code and message of the v1 CLI for the same error
+        exit_code = 255
+        self._trace(cmd, start, exit_code, "", stderr, log_name)
+        self._lines(stderr, log_name, on_stderr)
+        self._command_runner.log(f"Exit code: {exit_code}", log_name)
+        raise ExecError(exit_code, "", stderr, f"Exec failed: {stderr}")
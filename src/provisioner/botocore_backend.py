@@ -0,0 +1,218 @@
+import base64
+import datetime
+import json
+import threading
+
+from .backend import Backend, Unsupported
+
+# The aws CLI names a few services differently from botocore
+CLI_SERVICE_NAMES = {"s3api": "s3"}
+
+# Commands the CLI implements itself rather than as a single API operation
+CLI_CUSTOMISATIONS = {"s3"}
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+    raise TypeError(f"Can't serialise {type(value).__name__} to JSON")
+
+
+class BotocoreBackend(Backend):
+    name = "botocore"
+    max_pool_connections = 50
+
+    def __init__(self, command_runner, region, endpoint_url=None, session=None):
+        try:
+            import botocore.session
+            from botocore.config import Config
+        except ImportError as e:
+            raise Exception(
+                "The botocore backend needs botocore to be installed, try 'pip install botocore'"
+            ) from e
+        super().__init__(command_runner)
+        self.region = region
+        self.endpoint_url = endpoint_url
+        if session is None:
+            session = botocore.session.Session()
+            env = command_runner.env
+            if "AWS_ACCESS_KEY_ID" in env:
+                session.set_credentials(
+                    env["AWS_ACCESS_KEY_ID"],
+                    env["AWS_SECRET_ACCESS_KEY"],
+                    env.get("AWS_SESSION_TOKEN"),
+                )
+        self._session = session
+        config = dict(max_pool_connections=self.max_pool_connections)
+        if endpoint_url is not None:
+            # LocalStack doesn't resolve virtual host style bucket names
+            config["s3"] = {"addressing_style": "path"}
+        self._config = Config(**config)
+        # Sessions aren't thread safe, but the clients they create are
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._operations = {}
+
+    def client(self, service):
+        with self._lock:
+            if service not in self._clients:
+                self._clients[service] = self._session.create_client(
+                    service,
+                    region_name=self.region,
+                    endpoint_url=self.endpoint_url,
+                    config=self._config,
+                )
+            return self._clients[service]
+
+    def _operation_names(self, service):
+        from botocore import xform_name
+
+        with self._lock:
+            if service not in self._operations:
+                if service not in self._session.get_available_services():
+                    self._operations[service] = None
+                else:
+                    service_model = self._session.get_service_model(service)
+                    self._operations[service] = (
+                        service_model,
+                        {
+                            xform_name(name, "-"): name
+                            for name in service_model.operation_names
+                        },
+                    )
+            return self._operations[service]
+
+    def _parse(self, cmd):
+        from botocore import xform_name
+
+        if len(cmd) < 2 or cmd[0] in CLI_CUSTOMISATIONS:
+            raise Unsupported()
+        service = CLI_SERVICE_NAMES.get(cmd[0], cmd[0])
+        operations = self._operation_names(service)
+        if operations is None or cmd[1] not in operations[1]:
+            raise Unsupported()
+        service_model, operation_names = operations
+        operation_name = operation_names[cmd[1]]
+        input_shape = service_model.operation_model(operation_name).input_shape
+        members = {}
+        names = {}
+        if input_shape is not None:
+            members = {
+                xform_name(name, "-"): shape
+                for name, shape in input_shape.members.items()
+            }
+            names = {xform_name(name, "-"): name for name in input_shape.members}
+        params = {}
+        paginate = True
+        args = cmd[2:]
+        i = 0
+        while i < len(args):
+            # Positional arguments are all CLI customisations, like get-object's outfile
+            if not args[i].startswith("--"):
+                raise Unsupported()
+            option = args[i][2:]
+            i += 1
+            values = []
+            while i < len(args) and not args[i].startswith("--"):
+                values.append(args[i])
+                i += 1
+            if option == "no-paginate" and not values:
+                paginate = False
+            elif option in members:
+                params[names[option]] = self._parse_value(members[option], values)
+            elif (
+                option.startswith("no-")
+                and option[3:] in members
+                and members[option[3:]].type_name == "boolean"
+                and not values
+            ):
+                params[names[option[3:]]] = False
+            else:
+                # Global options like --query and --output are left to the CLI
+                raise Unsupported()
+        return service, operation_name, params, paginate
+
+    def _parse_value(self, shape, values):
+        for value in values:
+            if value.startswith(("file://", "fileb://")):
+                raise Unsupported()
+        if shape.type_name == "boolean" and not values:
+            return True
+        if shape.type_name == "list":
+            if len(values) == 1 and values[0].lstrip().startswith("["):
+                return json.loads(values[0])
+            return [self._parse_scalar(shape.member, value) for value in values]
+        if len(values) != 1:
+            raise Unsupported()
+        value = values[0]
+        if shape.type_name in ("structure", "map"):
+            if value.lstrip().startswith("{"):
+                return json.loads(value)
+            return self._parse_shorthand(shape, value)
+        return self._parse_scalar(shape, value)
+
+    def _parse_shorthand(self, shape, value):
+        # Only the flat Key=Value,Key=Value form of the CLI shorthand syntax
+        result = {}
+        for pair in value.split(","):
+            if "=" not in pair:
+                raise Unsupported()
+            key, item = pair.split("=", 1)
+            if shape.type_name == "map":
+                result[key] = self._parse_scalar(shape.value, item)
+            elif key in shape.members:
+                result[key] = self._parse_scalar(shape.members[key], item)
+            else:
+                raise Unsupported()
+        return result
+
+    def _parse_scalar(self, shape, value):
+        if shape.type_name in ("string", "timestamp"):
+            return value
+        if shape.type_name in ("integer", "long"):
+            return int(value)
+        if shape.type_name in ("float", "double"):
+            return float(value)
+        if shape.type_name == "boolean":
+            return value.lower() == "true"
+        raise Unsupported()
+
+    def handles(self, cmd):
+        try:
+            self._parse(cmd)
+        except Unsupported:
+            return False
+        return True
+
+    def aws(self, cmd, log_name="", on_stdout=None, on_stderr=None, max_output=None):
+        from botocore import xform_name
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        service, operation_name, params, paginate = self._parse(cmd)
+        start = self._log_command(cmd, log_name)
+        client = self.client(service)
+        method = xform_name(operation_name)
+        try:
+            # Like the CLI, return every page of paginated operations unless
+            # --no-paginate was given
+            if paginate and client.can_paginate(method):
+                result = (
+                    client.get_paginator(method).paginate(**params).build_full_result()
+                )
+            else:
+                result = getattr(client, method)(**params)
+        except ClientError as e:
+            error = e.response.get("Error", {})
+            stderr = f"\nAn error occurred ({error.get('Code', 'Unknown')}) when calling the {operation_name} operation: {error.get('Message', '')}\n"
+            self._raise(cmd, start, stderr, log_name, on_stderr)
+        except BotoCoreError as e:
+            self._raise(cmd, start, f"\n{e}\n", log_name, on_stderr)
+        result.pop("ResponseMetadata", None)
+        if not result:
+            # The CLI prints nothing at all for an empty response
+            stdout = ""
+        else:
+            stdout = json.dumps(result, indent=4, default=_json_default) + "\n"
+        return self._return(cmd, start, stdout, log_name, on_stdout, max_output)
@@ -0,0 +1,140 @@
+import os
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from . import CommandRunner, AWSCommandRunner, StackProvisioner, DeployError
+from .spans import span
+
+
+class Target:
+    def __init__(
+        self,
+        region: str,
+        account: str,
+        user: str,
+        env: dict | None = None,
+        max_workers: int = 4,
+        stack_provisioner_args: dict | None = None,
+    ):
+        self.region = region
+        self.account = account
+        self.user = user
+        # The credentials for this account, the region is set from region
+        self.env: dict = dict(os.environ if env is None else env)
+        self.env["AWS_REGION"] = region
+        self.env["AWS_DEFAULT_REGION"] = region
+        # How many of this target's stacks deploy at once
+        self.max_workers = max_workers
+        # Merged over FanOut's, e.g. for a cloudformation_bucket per region
+        self.stack_provisioner_args: dict = stack_provisioner_args or {}
+
+    @property
+    def name(self):
+        return f"{self.account}-{self.region}"
+
+    def __repr__(self):
+        return f"Target({self.region!r}, {self.account!r})"
+
+
+class FanOut:
+    def __init__(
+        self,
+        targets: list,
+        stacks: list,
+        stack_provisioner_args: dict,
+        log_dir: str = ".",
+        max_targets: int | None = None,
+        aws_command_runner=None,
+    ):
+        self.targets = targets
+        self.stacks = stacks
+        self.stack_provisioner_args = stack_provisioner_args
+        self.log_dir = log_dir
+        self.max_targets = max_targets or len(targets) or 1
+        # Called as aws_command_runner(target, command_runner), an
+        # AWSCommandRunner for the target by default
+        self.aws_command_runner = aws_command_runner or (
+            lambda target, command_runner: AWSCommandRunner(
+                command_runner,
+                region=target.region,
+                account=target.account,
+                user=target.user,
+            )
+        )
+
+    def log_file(self, target):
+        return os.path.join(self.log_dir, f"{target.name}.log")
+
+    def provision(self, target):
+        with span("FanOut.provision", region=target.region, account=target.account):
+            command_runner = CommandRunner(self.log_file(target), env=target.env)
+            stack_provisioner = StackProvisioner(
+                self.aws_command_runner(target, command_runner),
+                **{**self.stack_provisioner_args, **target.stack_provisioner_args},
+                stacks=self.stacks,
+            )
+            return stack_provisioner.deploy_stacks(max_workers=target.max_workers)
+
+    def _provision(self, target):
+        start = time.monotonic()
+        try:
+            deployed = self.provision(target)
+        except Exception as e:
+            # Anything from a bad credential to a failed stack only stops
+            # this target
+            return {
+                "status": "failed",
+                "duration": time.monotonic() - start,
+                "deployed": [],
+                "failed": sorted(e.failed) if isinstance(e, DeployError) else [],
+                "error": e,
+            }
+        return {
+            "status": "succeeded",
+            "duration": time.monotonic() - start,
+            "deployed": deployed,
+            "failed": [],
+            "error": None,
+        }
+
+    def run(self):
+        with span("FanOut.run", targets=len(self.targets)):
+            # Every target is in its own region or account, so they only
+            # wait on each other for a slot
+            with ThreadPoolExecutor(max_workers=self.max_targets) as executor:
+                futures = [
+                    executor.submit(
+                        contextvars.copy_context().run, self._provision, target
+                    )
+                    for target in self.targets
+                ]
+                results = {
+                    target.name: future.result()
+                    for target, future in zip(self.targets, futures)
+                }
+        print(self.matrix(results))
+        return results
+
+    def matrix(self, results):
+        regions = sorted({target.region for target in self.targets})
+        accounts = sorted({target.account for target in self.targets})
+        by_cell = {(t.account, t.region): results[t.name] for t in self.targets}
+        width = max([len(r) for r in regions] + [16])
+        lines = [f"{'account':<14}" + "".join(f"{r:>{width}}" for r in regions)]
+        for account in accounts:
+            cells = []
+            for region in regions:
+                result = by_cell.get((account, region))
+                if result is None:
+                    cells.append(f"{'-':>{width}}")
+                    continue
+                status = "ok" if result["status"] == "succeeded" else "FAILED"
+                cell = f"{status} {result['duration']:.1f}s"
+                cells.append(f"{cell:>{width}}")
+            lines.append(f"{account:<14}" + "".join(cells))
+        for target in self.targets:
+            error = results[target.name]["error"]
+            if error is not None:
+                lines.append(f"{target.name}: {error} (see {self.log_file(target)})")
+        return "\n".join(lines)
@@ -0,0 +1,38 @@
+import os
+import contextlib
+
+
+def walk_files(directory):
+    # (name relative to directory with / separators, path), each directory's
+    # files sorted and before its subdirectories', skipping dot files and
+    # directories like .git and .venv
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(names):
+            if name.startswith("."):
+                continue
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, directory).replace(os.sep, "/"), path
+
+
+@contextlib.contextmanager
+def replace_file(path, mode="w"):
+    # Written beside path then renamed over it, so a concurrent reader never
+    # sees a partial file. The temporary file's name is unique, even between
+    # writers in one process, and a dot file so it's never hashed. Like every
+    # mkstemp file only its owner can read it
+    # Only imported when a file is written, importing provisioner stays cheap
+    import tempfile
+
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".",
+        prefix=f".{os.path.basename(path)}.",
+        suffix=".tmp",
+    )
+    try:
+        with open(fd, mode) as fp:
+            yield fp
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
@@ -0,0 +1,193 @@
+import os
+import re
+import json
+import hashlib
+import mimetypes
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from .files import walk_files
+from .multipart import MULTIPART_THRESHOLD, PART_SIZE, upload_file
+from .spans import span
+
+# Like webpack's [contenthash], e.g. app.3f2a9c1b.js or app-3f2a9c1b5e.css
+HASHED_NAME = re.compile(r"[.-][0-9a-f]{8,}\.[^./]+$")
+
+# The system's mime.types varies, and is often wrong or missing for these
+CONTENT_TYPES = {
+    ".html": "text/html; charset=utf-8",
+    ".js": "text/javascript; charset=utf-8",
+    ".mjs": "text/javascript; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+    ".json": "application/json",
+    ".map": "application/json",
+    ".webmanifest": "application/manifest+json",
+    ".svg": "image/svg+xml",
+    ".wasm": "application/wasm",
+    ".woff": "font/woff",
+    ".woff2": "font/woff2",
+}
+
+
+class FrontendPublisher:
+    # The aws s3 cp defaults, so objects it uploaded still compare equal
+    multipart_threshold = MULTIPART_THRESHOLD
+    part_size = PART_SIZE
+    # S3's limit for one delete-objects call
+    delete_batch_size = 1000
+    immutable_cache_control = "public, max-age=31536000, immutable"
+    default_cache_control = "no-cache"
+
+    def __init__(
+        self,
+        aws_command_runner,
+        bucket: str,
+        build_dir: str,
+        prefix: str = "",
+        max_workers: int = 8,
+        hashed_name=HASHED_NAME,
+    ):
+        self.aws_command_runner = aws_command_runner
+        self.bucket = bucket
+        self.build_dir = build_dir
+        self.prefix = prefix
+        self.max_workers = max_workers
+        self.hashed_name = hashed_name
+
+    def local_files(self):
+        return {self.prefix + name: path for name, path in walk_files(self.build_dir)}
+
+    def etag(self, path):
+        # What S3 reports for the object after we upload it, the MD5 of the
+        # file, or for multipart uploads the MD5 of the part MD5s and the
+        # number of parts
+        size = os.path.getsize(path)
+        with open(path, "rb") as fp:
+            if size < self.multipart_threshold:
+                h = hashlib.md5()
+                for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+                    h.update(chunk)
+                return f'"{h.hexdigest()}"'
+            digests = [
+                hashlib.md5(part).digest()
+                for part in iter(lambda: fp.read(self.part_size), b"")
+            ]
+        return f'"{hashlib.md5(b"".join(digests)).hexdigest()}-{len(digests)}"'
+
+    def remote_etags(self):
+        # The CLI follows the continuation tokens and merges every page
+        stdout, _ = self.aws_command_runner.aws(
+            [
+                "s3api",
+                "list-objects-v2",
+                "--bucket",
+                self.bucket,
+                "--prefix",
+                self.prefix,
+            ]
+        )
+        if not stdout.strip():
+            return {}
+        return {o["Key"]: o["ETag"] for o in json.loads(stdout).get("Contents") or []}
+
+    def cache_control(self, key):
+        if self.hashed_name.search(key):
+            return self.immutable_cache_control
+        return self.default_cache_control
+
+    def content_type(self, key):
+        extension = os.path.splitext(key)[1].lower()
+        if extension in CONTENT_TYPES:
+            return CONTENT_TYPES[extension]
+        return mimetypes.guess_type(key)[0] or "application/octet-stream"
+
+    def _headers(self, key):
+        return [
+            "--content-type",
+            self.content_type(key),
+            "--cache-control",
+            self.cache_control(key),
+        ]
+
+    def upload(self, key, path, part_executor=None):
+        upload_file(
+            self.aws_command_runner,
+            self.bucket,
+            key,
+            path,
+            self._headers(key),
+            multipart_threshold=self.multipart_threshold,
+            part_size=self.part_size,
+            max_parts=self.max_workers,
+            part_executor=part_executor,
+        )
+
+    def delete(self, keys):
+        for i in range(0, len(keys), self.delete_batch_size):
+            batch = keys[i : i + self.delete_batch_size]
+            stdout, _ = self.aws_command_runner.aws(
+                [
+                    "s3api",
+                    "delete-objects",
+                    "--bucket",
+                    self.bucket,
+                    "--delete",
+                    json.dumps(
+                        {"Objects": [{"Key": key} for key in batch], "Quiet": True}
+                    ),
+                ]
+            )
+            errors = json.loads(stdout).get("Errors", []) if stdout.strip() else []
+            if errors:
+                raise Exception(
+                    f"Failed to delete {len(errors)} objects from '{self.bucket}', e.g. {errors[0]['Key']}: {errors[0].get('Message', '')}"
+                )
+
+    def publish(self, delete: bool = True):
+        with span(
+            "FrontendPublisher.publish", bucket=self.bucket, prefix=self.prefix
+        ) as trace_span:
+            files = self.local_files()
+            with ThreadPoolExecutor(
+                max_workers=self.max_workers
+            ) as executor, ThreadPoolExecutor(
+                max_workers=self.max_workers
+            ) as part_executor:
+                remote = executor.submit(
+                    contextvars.copy_context().run, self.remote_etags
+                )
+                etags = dict(zip(files, executor.map(self.etag, files.values())))
+                remote = remote.result()
+                changed = [key for key in files if remote.get(key) != etags[key]]
+                # Hashed assets go first so a new index.html never refers to
+                # files that aren't there yet
+                hashed = [key for key in changed if self.hashed_name.search(key)]
+                rest = [key for key in changed if not self.hashed_name.search(key)]
+                for keys in [hashed, rest]:
+                    futures = [
+                        executor.submit(
+                            contextvars.copy_context().run,
+                            self.upload,
+                            key,
+                            files[key],
+                            part_executor,
+                        )
+                        for key in keys
+                    ]
+                    for future in futures:
+                        future.result()
+            # Only once everything new is in place
+            stale = sorted(key for key in remote if key not in files)
+            if delete:
+                self.delete(stale)
+            trace_span.set_attribute("uploaded", len(changed))
+            trace_span.set_attribute("deleted", len(stale) if delete else 0)
+            print(
+                f"Uploaded {len(changed)} of {len(files)} files to '{self.bucket}'"
+                + (f" and deleted {len(stale)} stale objects." if delete else ".")
+            )
+            return {
+                "uploaded": sorted(changed),
+                "unchanged": len(files) - len(changed),
+                "deleted": stale if delete else [],
+            }
@@ -0,0 +1,131 @@
+import os
+import json
+import tempfile
+import contextvars
+from concurrent.futures import Future, wait
+
+# The aws s3 cp defaults
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+PART_SIZE = 8 * 1024 * 1024
+
+
+def upload_file(
+    aws_command_runner,
+    bucket: str,
+    key: str,
+    path: str,
+    args: list | None = None,
+    multipart_threshold: int = MULTIPART_THRESHOLD,
+    part_size: int = PART_SIZE,
+    max_parts: int = 8,
+    part_executor=None,
+):
+    # args are the object's headers like --content-type, given to put-object
+    # or create-multipart-upload. Parts are uploaded on part_executor, or one
+    # after another without it
+    args = args or []
+    log_name = f"[{key}] "
+    if os.path.getsize(path) < multipart_threshold:
+        aws_command_runner.aws(
+            ["s3api", "put-object", "--bucket", bucket, "--key", key]
+            + ["--body", path]
+            + args,
+            log_name=log_name,
+        )
+        return
+    stdout, _ = aws_command_runner.aws(
+        ["s3api", "create-multipart-upload", "--bucket", bucket, "--key", key] + args,
+        log_name=log_name,
+    )
+    upload_id = json.loads(stdout)["UploadId"]
+
+    def upload_part(number, part):
+        try:
+            stdout, _ = aws_command_runner.aws(
+                [
+                    "s3api",
+                    "upload-part",
+                    "--bucket",
+                    bucket,
+                    "--key",
+                    key,
+                    "--upload-id",
+                    upload_id,
+                    "--part-number",
+                    str(number),
+                    "--body",
+                    part,
+                ],
+                log_name=log_name,
+            )
+        finally:
+            os.remove(part)
+        return {"ETag": json.loads(stdout)["ETag"], "PartNumber": number}
+
+    try:
+        futures = []
+        with tempfile.TemporaryDirectory() as tmp:
+            try:
+                with open(path, "rb") as fp:
+                    for number, data in enumerate(
+                        iter(lambda: fp.read(part_size), b""), 1
+                    ):
+                        # Only max_parts parts are on disk at once, however
+                        # big the file is
+                        if number > max_parts:
+                            futures[number - 1 - max_parts].result()
+                        # upload-part only reads its body from a file
+                        part = os.path.join(tmp, str(number))
+                        with open(part, "wb") as out:
+                            out.write(data)
+                        if part_executor is None:
+                            future = Future()
+                            future.set_result(upload_part(number, part))
+                        else:
+                            future = part_executor.submit(
+                                contextvars.copy_context().run,
+                                upload_part,
+                                number,
+                                part,
+                            )
+                        futures.append(future)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+            finally:
+                # Nothing is still reading a part when the directory goes
+                wait(futures)
+            etags = [future.result() for future in futures]
+        aws_command_runner.aws(
+            [
+                "s3api",
+                "complete-multipart-upload",
+                "--bucket",
+                bucket,
+                "--key",
+                key,
+                "--upload-id",
+                upload_id,
+                "--multipart-upload",
+                json.dumps({"Parts": etags}),
+            ],
+            log_name=log_name,
+        )
+    except Exception:
+        # Otherwise the parts are kept, and charged for, until a lifecycle
+        # rule removes them
+        aws_command_runner.aws(
+            [
+                "s3api",
+                "abort-multipart-upload",
+                "--bucket",
+                bucket,
+                "--key",
+                key,
+                "--upload-id",
+                upload_id,
+            ],
+            log_name=log_name,
+        )
+        raise
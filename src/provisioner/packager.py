@@ -0,0 +1,182 @@
+import os
+import stat
+import hashlib
+import zipfile
+import contextvars
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from . import ExecError
+from .files import walk_files, replace_file
+from .multipart import MULTIPART_THRESHOLD, PART_SIZE, upload_file
+from .spans import span
+
+# Every entry gets the earliest time a zip can hold, so the same files always
+# make the same zip
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+# Part of every tree hash, change it when the zips built from a tree change
+ZIP_FORMAT = "1"
+
+
+def source_files(source_dir):
+    # (archive name, path) sorted by name, skipping things like .git and .venv
+    return sorted(walk_files(source_dir))
+
+
+def _executable(path):
+    return bool(os.stat(path).st_mode & stat.S_IXUSR)
+
+
+def tree_hash(source_dir, files=None):
+    if files is None:
+        files = source_files(source_dir)
+    h = hashlib.sha256(f"zip-format-{ZIP_FORMAT}".encode("utf8"))
+    for name, path in files:
+        h.update(
+            f"\0{name}\0{_executable(path)}\0{os.path.getsize(path)}\0".encode("utf8")
+        )
+        with open(path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def write_zip(files, zip_path):
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, path in files:
+            info = zipfile.ZipInfo(name, date_time=ZIP_DATE_TIME)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            # Only the executable bit survives, the same on every machine
+            info.create_system = 3
+            mode = 0o755 if _executable(path) else 0o644
+            info.external_attr = (stat.S_IFREG | mode) << 16
+            size = os.path.getsize(path)
+            # Streamed from the file, so a big dependency never sits in memory
+            with open(path, "rb") as src, zf.open(
+                info, "w", force_zip64=size >= zipfile.ZIP64_LIMIT
+            ) as dest:
+                for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                    dest.write(chunk)
+
+
+def build(source_dir, cache_dir):
+    # Runs in a worker process: (tree hash, zip path, whether it was built),
+    # a zip already in the cache for the same tree is used as it is
+    files = source_files(source_dir)
+    if not files:
+        raise Exception(f"There are no files to package in '{source_dir}'")
+    tree = tree_hash(source_dir, files)
+    zip_path = os.path.join(cache_dir, f"{tree}.zip")
+    if os.path.exists(zip_path):
+        return tree, zip_path, False
+    with replace_file(zip_path, "wb") as fp:
+        write_zip(files, fp)
+    return tree, zip_path, True
+
+
+class LambdaPackager:
+    multipart_threshold = MULTIPART_THRESHOLD
+    part_size = PART_SIZE
+
+    def __init__(
+        self,
+        aws_command_runner,
+        bucket: str,
+        prefix: str = "",
+        cache_dir: str = ".lambda-cache",
+        max_workers: int | None = None,
+        max_uploads: int = 8,
+    ):
+        self.aws_command_runner = aws_command_runner
+        self.bucket = bucket
+        self.prefix = prefix
+        # Built zips by tree hash, reused until the files in the tree change
+        self.cache_dir = cache_dir
+        # Processes building zips, one per CPU by default
+        self.max_workers = max_workers
+        # Objects, and parts of each multipart upload, uploading at once
+        self.max_uploads = max_uploads
+
+    def key(self, name, tree):
+        return f"{self.prefix}{name}/{tree}.zip"
+
+    def exists(self, key):
+        try:
+            self.aws_command_runner.aws(
+                ["s3api", "head-object", "--bucket", self.bucket, "--key", key],
+                log_name=f"[{key}] ",
+            )
+        except ExecError as e:
+            if "(404)" in e.stderr or "(NoSuchKey)" in e.stderr:
+                return False
+            raise
+        return True
+
+    def upload(self, key, path, part_executor=None):
+        upload_file(
+            self.aws_command_runner,
+            self.bucket,
+            key,
+            path,
+            ["--content-type", "application/zip"],
+            multipart_threshold=self.multipart_threshold,
+            part_size=self.part_size,
+            max_parts=self.max_uploads,
+            part_executor=part_executor,
+        )
+
+    def _upload_if_missing(self, key, path, part_executor=None):
+        if self.exists(key):
+            return False
+        self.upload(key, path, part_executor)
+        return True
+
+    def package(self, functions: dict):
+        # functions is {name: source directory}, the result is
+        # {name: {bucket, key, hash, built, uploaded}}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with span(
+            "LambdaPackager.package", bucket=self.bucket, functions=len(functions)
+        ) as trace_span:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+                futures = {
+                    name: pool.submit(build, source_dir, self.cache_dir)
+                    for name, source_dir in functions.items()
+                }
+                built = {name: future.result() for name, future in futures.items()}
+            # Zips are named by their tree hash, so one already in the bucket
+            # has the same contents. Parts get their own pool, so objects
+            # waiting on their parts never hold every thread
+            with ThreadPoolExecutor(
+                max_workers=self.max_uploads
+            ) as executor, ThreadPoolExecutor(
+                max_workers=self.max_uploads
+            ) as part_executor:
+                futures = {
+                    name: executor.submit(
+                        contextvars.copy_context().run,
+                        self._upload_if_missing,
+                        self.key(name, tree),
+                        zip_path,
+                        part_executor,
+                    )
+                    for name, (tree, zip_path, _) in built.items()
+                }
+                uploaded = {name: future.result() for name, future in futures.items()}
+            packages = {
+                name: {
+                    "bucket": self.bucket,
+                    "key": self.key(name, tree),
+                    "hash": tree,
+                    "built": was_built,
+                    "uploaded": uploaded[name],
+                }
+                for name, (tree, _, was_built) in built.items()
+            }
+            built_count = sum(p["built"] for p in packages.values())
+            uploaded_count = sum(p["uploaded"] for p in packages.values())
+            trace_span.set_attribute("built", built_count)
+            trace_span.set_attribute("uploaded", uploaded_count)
+            print(
+                f"Built {built_count} and uploaded {uploaded_count} of {len(packages)} Lambda packages to '{self.bucket}'."
+            )
+            return packages
@@ -0,0 +1,178 @@
+import json
+import time
+import random
+import threading
+import contextvars
+
+# Nested timing spans in the style of OpenTelemetry. Nothing is recorded until
+# set_tracer() is called, and until then span() hands back one shared no-op
+# context manager so the instrumented code pays for little more than a call.
+
+_current_span = contextvars.ContextVar("provisioner_span", default=None)
+_tracer = None
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    def __init__(self, exporter, name, attributes, parent):
+        self._exporter = exporter
+        self.name = name
+        self.attributes = attributes
+        if parent is None:
+            self.trace_id = f"{random.getrandbits(128):032x}"
+            self.parent_id = None
+        else:
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.start = None
+        self.end = None
+        self.error = None
+        self._token = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    @property
+    def duration(self):
+        return (self.end - self.start) / 1e9
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        self.start = time.time_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.time_ns()
+        _current_span.reset(self._token)
+        if exc is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        self._exporter.export(self)
+        return False
+
+    def __repr__(self):
+        return f"Span({self.name!r}, {self.attributes!r})"
+
+
+class Tracer:
+    def __init__(self, exporter):
+        self.exporter = exporter
+
+    def span(self, name, /, **attributes):
+        return Span(self.exporter, name, attributes, _current_span.get())
+
+
+class InMemoryExporter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.spans = []
+
+    def export(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def shutdown(self):
+        pass
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        # int64 is a string in OTLP JSON
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_json(spans, service_name="provisioner"):
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {"key": "service.name", "value": _otlp_value(service_name)}
+                    ]
+                },
+                "scopeSpans": [
+                    {
+                        "scope": {"name": "provisioner"},
+                        "spans": [
+                            {
+                                "traceId": span.trace_id,
+                                "spanId": span.span_id,
+                                **(
+                                    {"parentSpanId": span.parent_id}
+                                    if span.parent_id is not None
+                                    else {}
+                                ),
+                                "name": span.name,
+                                # SPAN_KIND_INTERNAL
+                                "kind": 1,
+                                "startTimeUnixNano": str(span.start),
+                                "endTimeUnixNano": str(span.end),
+                                "attributes": [
+                                    {"key": key, "value": _otlp_value(value)}
+                                    for key, value in span.attributes.items()
+                                ],
+                                # STATUS_CODE_ERROR or STATUS_CODE_UNSET
+                                "status": (
+                                    {"code": 2, "message": span.error}
+                                    if span.error is not None
+                                    else {}
+                                ),
+                            }
+                            for span in spans
+                        ],
+                    }
+                ],
+            }
+        ]
+    }
+
+
+class OTLPFileExporter:
+    # One OTLP/JSON ExportTraceServiceRequest per line, the format the
+    # OpenTelemetry Collector's file exporter writes and its otlpjsonfile
+    # receiver reads, so a CI artifact can be loaded into any OTLP backend
+    def __init__(self, path, service_name="provisioner"):
+        self.service_name = service_name
+        self._lock = threading.Lock()
+        self._file = open(path, "w")
+
+    def export(self, span):
+        line = json.dumps(otlp_json([span], self.service_name)) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def shutdown(self):
+        with self._lock:
+            self._file.close()
+
+
+def set_tracer(tracer):
+    global _tracer
+    previous = _tracer
+    _tracer = tracer
+    return previous
+
+
+def span(name, /, **attributes):
+    if _tracer is None:
+        return NOOP_SPAN
+    return _tracer.span(name, **attributes)
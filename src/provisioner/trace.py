@@ -0,0 +1,68 @@
+import os
+import sys
+import json
+import shlex
+import argparse
+import collections
+
+# Commands whose second and third terms are the AWS service and operation
+AWS_COMMANDS = ["aws", "awslocal", "botocore", "fake"]
+
+
+def read_trace(path):
+    with open(path, "r") as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+def operation(argv):
+    command = os.path.basename(argv[0])
+    if command not in AWS_COMMANDS:
+        return command
+    # Skip global options like --region=eu-west-2 before the service
+    terms = [term for term in argv[1:] if not term.startswith("--")]
+    return " ".join(terms[:2])
+
+
+def summarise(records, top=10, width=100):
+    lines = []
+    if not records:
+        return "No commands traced\n"
+    lines.append("Slowest commands:")
+    for record in sorted(records, key=lambda r: r["duration"], reverse=True)[:top]:
+        cmd = " ".join([shlex.quote(term) for term in record["argv"]])
+        if len(cmd) > width:
+            cmd = cmd[: width - 3] + "..."
+        lines.append(
+            f"  {record['duration']:>9.3f}s  exit {record['exit_code']:<3}  {record['log_name']}{cmd}"
+        )
+    totals = collections.defaultdict(float)
+    counts = collections.Counter()
+    for record in records:
+        totals[operation(record["argv"])] += record["duration"]
+        counts[operation(record["argv"])] += 1
+    lines.append("")
+    lines.append("Time per service/operation:")
+    for name, total in sorted(totals.items(), key=lambda item: item[1], reverse=True):
+        lines.append(f"  {total:>9.3f}s  {counts[name]:>5} calls  {name}")
+    total = sum(record["duration"] for record in records)
+    # Commands run in parallel overlap, so the wall clock time can be much less
+    wall = max(r["end"] for r in records) - min(r["start"] for r in records)
+    lines.append("")
+    lines.append(
+        f"{len(records)} commands took {total:.3f}s in total over {wall:.3f}s of wall clock time"
+    )
+    return "\n".join(lines) + "\n"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarise a CommandRunner trace file")
+    parser.add_argument("trace", help="the JSON Lines file passed as trace=")
+    parser.add_argument(
+        "--top", type=int, default=10, help="how many of the slowest commands to show"
+    )
+    args = parser.parse_args(argv)
+    sys.stdout.write(summarise(read_trace(args.trace), top=args.top))
+
+
+if __name__ == "__main__":
+    main()
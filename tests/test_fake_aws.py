@@ -0,0 +1,282 @@
+import io
+import os
+import json
+import time
+import threading
+import tempfile
+import contextlib
+from unittest import TestCase
+from provisioner import (
+    CommandRunner,
+    AWSCommandRunner,
+    StackProvisioner,
+    StackWaiter,
+    Stack,
+    Output,
+    ExecError,
+    DeployError,
+)
+from provisioner.fake_aws import FakeAWS
+
+env = dict(
+    AWS_REGION="eu-west-2",
+    AWS_ACCESS_KEY_ID="test",
+    AWS_SECRET_ACCESS_KEY="test",
+    PATH="",
+)
+
+TEMPLATE = """Parameters:
+  Name:
+    Type: String
+Resources:
+  Bucket:
+    Type: AWS::S3::Bucket
+    Properties:
+      BucketName: !Ref Name
+Outputs:
+  BucketName:
+    Value: !Ref Name
+"""
+
+
+class TestFakeAWS(TestCase):
+    def setUp(self):
+        cwd = os.getcwd()
+        tmp = tempfile.TemporaryDirectory()
+        os.chdir(tmp.name)
+        self.addCleanup(tmp.cleanup)
+        self.addCleanup(os.chdir, cwd)
+        with open("a.yml", "w") as fp:
+            fp.write(TEMPLATE)
+        with open("b.yml", "w") as fp:
+            fp.write(TEMPLATE.replace("AWS::S3::Bucket", "AWS::SQS::Queue"))
+        self.fake = FakeAWS(account="123456789012", user="user")
+        # An empty PATH means any command reaching the CLI fails
+        self.command_runner = CommandRunner(logfilename="test.log", env=env)
+        self.aws_command_runner = AWSCommandRunner(
+            self.command_runner,
+            "eu-west-2",
+            "123456789012",
+            "user",
+            backend=self.fake.backend,
+            rate_limits={},
+        )
+        self.aws_command_runner.base_backoff = 0.01
+
+    def provisioner(self, stacks):
+        return StackProvisioner(
+            self.aws_command_runner,
+            cloudformation_bucket="artifacts",
+            stack_name_prefix="Test-",
+            global_postfix="",
+            stacks=stacks,
+            waiter=StackWaiter(
+                self.aws_command_runner, min_interval=0.01, max_interval=0.05
+            ),
+        )
+
+    def stacks(self):
+        return [
+            Stack("A", "a.yml", parameters={"Name": "a"}, artifacts=["a.yml"]),
+            Stack(
+                "B",
+                "b.yml",
+                parameters={"Name": Output("A", "BucketName")},
+                artifacts=["b.yml"],
+            ),
+        ]
+
+    def test_deploy(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            deployed = self.provisioner(self.stacks()).deploy_stacks()
+        self.assertEqual(["A", "B"], sorted(deployed))
+        a = self.fake.stacks[("eu-west-2", "Test-A")]
+        b = self.fake.stacks[("eu-west-2", "Test-B")]
+        self.assertEqual("CREATE_COMPLETE", a["StackStatus"])
+        self.assertEqual(
+            [{"ParameterKey": "Name", "ParameterValue": "a"}], b["Parameters"]
+        )
+        self.assertEqual("AWS::SQS::Queue", b["resources"]["Bucket"]["Type"])
+        self.assertEqual("Enabled", self.fake.buckets["artifacts"]["versioning"])
+        self.assertIn("Test-A/content-hash", self.fake.buckets["artifacts"]["objects"])
+
+        # Nothing changed, so only the snapshot and content hashes are read
+        self.fake.calls = []
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            self.provisioner(self.stacks()).deploy_stacks()
+        self.assertIn("Stack 'Test-A' is unchanged", stdout.getvalue())
+        self.assertNotIn(("eu-west-2", "cloudformation deploy"), self.fake.calls)
+
+        # A changed template is an update
+        with open("a.yml", "a") as fp:
+            fp.write("  Other:\n    Value: x\n")
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.provisioner(self.stacks()).deploy_stacks()
+        self.assertEqual("UPDATE_COMPLETE", a["StackStatus"])
+        self.assertEqual(
+            {"BucketName": "a", "Other": "x"},
+            {o["OutputKey"]: o["OutputValue"] for o in a["Outputs"]},
+        )
+        with open("test.log", "r") as fp:
+            self.assertIn(
+                "UPDATE_COMPLETE AWS::CloudFormation::Stack Test-A", fp.read()
+            )
+
+    def test_preview_uses_changed_outputs(self):
+        # B's parameter is A's output, which doesn't exist until A is deployed
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            created = self.provisioner(self.stacks()).preview_change_sets()
+        self.assertEqual(["A"], list(created))
+        self.assertIn(
+            "Stack 'Test-B' is previewed once the stacks it depends on are deployed.",
+            stdout.getvalue(),
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            deployed = self.provisioner(self.stacks()).deploy_stacks(preview=True)
+        self.assertEqual(["A", "B"], deployed)
+        b = self.fake.stacks[("eu-west-2", "Test-B")]
+        self.assertEqual(
+            [{"ParameterKey": "Name", "ParameterValue": "a"}], b["Parameters"]
+        )
+
+        # A's output changes, so B is updated with it rather than skipped
+        stacks = self.stacks()
+        stacks[0].parameters = {"Name": "a2"}
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            self.provisioner(stacks).deploy_stacks(preview=True)
+        self.assertNotIn("Stack 'Test-B' is unchanged", stdout.getvalue())
+        self.assertEqual(
+            [{"ParameterKey": "Name", "ParameterValue": "a2"}], b["Parameters"]
+        )
+        self.assertEqual("UPDATE_COMPLETE", b["StackStatus"])
+
+    def test_stacks_take_time(self):
+        self.fake.stack_seconds = 0.2
+        start = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.provisioner(self.stacks()[:1]).deploy_stacks()
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_deploy_waits_without_blocking_other_calls(self):
+        self.fake.stack_seconds = 0.3
+        self.fake.buckets["artifacts"] = {
+            "region": "eu-west-2",
+            "versioning": "Enabled",
+            "objects": {},
+        }
+        deploy = threading.Thread(
+            target=self.aws_command_runner.aws,
+            args=(
+                ["cloudformation", "deploy", "--stack-name", "Test-A"]
+                + ["--s3-bucket", "artifacts", "--template-file", "a.yml"]
+                + ["--parameter-overrides", "Name=a"],
+            ),
+        )
+        deploy.start()
+        while ("eu-west-2", "Test-A") not in self.fake.stacks:
+            time.sleep(0.01)
+        start = time.monotonic()
+        self.aws_command_runner.aws(
+            ["s3api", "get-bucket-versioning", "--bucket", "artifacts"]
+        )
+        self.assertLess(time.monotonic() - start, 0.2)
+        deploy.join()
+        self.assertEqual(
+            "CREATE_COMPLETE",
+            self.fake.stacks[("eu-west-2", "Test-A")]["StackStatus"],
+        )
+
+    def test_unreadable_events_fail_the_deploy(self):
+        waiter = StackWaiter(self.aws_command_runner)
+        self.assertIsNone(waiter.latest_event_id("Test-A"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.provisioner(self.stacks()[:1]).deploy_stacks()
+        with open("a.yml", "a") as fp:
+            fp.write("  Other:\n    Value: x\n")
+        self.fake.stack_seconds = 0.2
+        self.fake.calls = []
+        self.fake.fail(
+            "cloudformation describe-stack-events", code="AccessDenied", message="No"
+        )
+        # Rather than taking the last CREATE_COMPLETE as the update's result
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(DeployError):
+                self.provisioner(self.stacks()[:1]).deploy_stacks()
+        self.assertNotIn(
+            ("eu-west-2", "cloudformation execute-change-set"), self.fake.calls
+        )
+
+    def test_injected_throttling_is_retried(self):
+        self.fake.fail("cloudformation describe-stack-events", times=2)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.provisioner(self.stacks()[:1]).deploy_stacks()
+        with open("test.log", "r") as fp:
+            log = fp.read()
+        self.assertIn(
+            "An error occurred (Throttling) when calling the DescribeStackEvents operation: Rate exceeded",
+            log,
+        )
+        self.assertIn(
+            "Throttling error from cloudformation describe-stack-events, retrying",
+            log,
+        )
+
+    def test_failed_stack(self):
+        self.fake.fail_stack("Test-A")
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(DeployError) as cm:
+                self.provisioner(self.stacks()).deploy_stacks()
+        self.assertEqual(["A"], list(cm.exception.failed))
+        self.assertEqual(["B"], cm.exception.skipped)
+        self.assertEqual(
+            "ROLLBACK_COMPLETE",
+            self.fake.stacks[("eu-west-2", "Test-A")]["StackStatus"],
+        )
+
+    def test_errors(self):
+        with self.assertRaises(ExecError) as cm:
+            self.aws_command_runner.aws(
+                ["s3api", "get-bucket-versioning", "--bucket", "missing"]
+            )
+        self.assertEqual(255, cm.exception.exit_code)
+        self.assertIn("(NoSuchBucket)", cm.exception.stderr)
+        with self.assertRaises(ExecError) as cm:
+            self.aws_command_runner.aws(
+                ["cloudformation", "describe-stack-events", "--stack-name", "X"]
+            )
+        self.assertIn("Stack with id X does not exist", cm.exception.stderr)
+        with self.assertRaises(Exception) as cm:
+            self.aws_command_runner.aws(["ec2", "describe-instances"])
+        self.assertEqual(
+            "The fake AWS backend doesn't support 'ec2 describe-instances'",
+            str(cm.exception),
+        )
+
+    def test_objects(self):
+        self.aws_command_runner.aws(["s3api", "create-bucket", "--bucket", "b"])
+        with open("data", "wb") as fp:
+            fp.write(b"data")
+        self.aws_command_runner.aws(
+            [
+                "s3api",
+                "put-object",
+                "--bucket",
+                "b",
+                "--key",
+                "k",
+                "--body",
+                "data",
+                "--metadata",
+                "a=1,b=2",
+            ]
+        )
+        stdout, _ = self.aws_command_runner.aws(
+            ["s3api", "head-object", "--bucket", "b", "--key", "k"]
+        )
+        head = json.loads(stdout)
+        self.assertEqual({"a": "1", "b": "2"}, head["Metadata"])
+        self.assertEqual(4, head["ContentLength"])
+        stdout, _ = self.aws_command_runner.aws(
+            ["s3api", "list-objects-v2", "--bucket", "b", "--prefix", "x"]
+        )
+        self.assertEqual("", stdout)
@@ -0,0 +1,129 @@
+import io
+import os
+import re
+import json
+import time
+import tempfile
+import contextlib
+from unittest import TestCase
+from provisioner import Stack, ExecError, DeployError
+from provisioner.fanout import Target, FanOut
+
+
+class FakeAWSCommandRunner:
+    def __init__(self, target, command_runner, deploy_seconds, fail_stacks):
+        self.region = target.region
+        self.account = target.account
+        self.command_runner = command_runner
+        self.deploy_seconds = deploy_seconds
+        self.fail_stacks = fail_stacks
+
+    def aws(self, cmd, **kwargs):
+        self.command_runner.log(" ".join(cmd))
+        if cmd[:2] == ["s3api", "get-bucket-versioning"]:
+            return json.dumps({"Status": "Enabled"}), ""
+        if cmd[:2] == ["s3api", "head-object"]:
+            raise ExecError(255, "", "Not Found", "Exec failed: Not Found")
+        if cmd[:2] == ["cloudformation", "deploy"]:
+            time.sleep(self.deploy_seconds)
+            if cmd[cmd.index("--stack-name") + 1] in self.fail_stacks:
+                raise ExecError(255, "", "boom", "Exec failed: boom")
+        return "", ""
+
+
+class TestFanOut(TestCase):
+    def setUp(self):
+        cwd = os.getcwd()
+        tmp = tempfile.TemporaryDirectory()
+        os.chdir(tmp.name)
+        self.addCleanup(tmp.cleanup)
+        self.addCleanup(os.chdir, cwd)
+        os.mkdir("logs")
+        with open("a.yml", "w") as fp:
+            fp.write("a")
+        self.stacks = [Stack("A", "a.yml", artifacts=["a.yml"])]
+        self.env = dict(AWS_ACCESS_KEY_ID="id", AWS_SECRET_ACCESS_KEY="secret")
+
+    def fan_out(self, targets, deploy_seconds=0.0, fail=(), **p):
+        def aws_command_runner(target, command_runner):
+            return FakeAWSCommandRunner(
+                target,
+                command_runner,
+                deploy_seconds,
+                ["A"] if target.name in fail else [],
+            )
+
+        return FanOut(
+            targets,
+            self.stacks,
+            {"cloudformation_bucket": "artifacts"},
+            log_dir="logs",
+            aws_command_runner=aws_command_runner,
+            **p,
+        )
+
+    def test_targets_run_concurrently(self):
+        targets = [
+            Target(region, account, "user", env=self.env)
+            for account in ["111111111111", "222222222222"]
+            for region in ["eu-west-1", "eu-west-2", "us-east-1"]
+        ]
+        start = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = self.fan_out(targets, deploy_seconds=0.2).run()
+        # One after another this would take 1.2 seconds
+        self.assertLess(time.monotonic() - start, 0.6)
+        self.assertEqual(
+            {"succeeded"}, {result["status"] for result in results.values()}
+        )
+        self.assertEqual(["A"], results["111111111111-us-east-1"]["deployed"])
+        self.assertEqual(
+            sorted(f"{t.name}.log" for t in targets), sorted(os.listdir("logs"))
+        )
+        with open("logs/222222222222-eu-west-2.log", "r") as fp:
+            self.assertIn("cloudformation deploy", fp.read())
+
+    def test_max_targets(self):
+        targets = [
+            Target(region, "111111111111", "user", env=self.env)
+            for region in ["eu-west-1", "eu-west-2", "us-east-1"]
+        ]
+        start = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.fan_out(targets, deploy_seconds=0.1, max_targets=1).run()
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+
+    def test_failures_and_matrix(self):
+        targets = [
+            Target("eu-west-1", "111111111111", "user", env=self.env),
+            Target("eu-west-2", "111111111111", "user", env=self.env),
+            Target(
+                "eu-west-1",
+                "222222222222",
+                "user",
+                env=self.env,
+                stack_provisioner_args={"stack_name_prefix": "Other-"},
+            ),
+        ]
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            results = self.fan_out(targets, fail=["111111111111-eu-west-2"]).run()
+        failed = results["111111111111-eu-west-2"]
+        self.assertEqual("failed", failed["status"])
+        self.assertEqual(["A"], failed["failed"])
+        self.assertIsInstance(failed["error"], DeployError)
+        self.assertEqual("succeeded", results["111111111111-eu-west-1"]["status"])
+        # Each target's environment has its own region
+        self.assertEqual("eu-west-2", targets[1].env["AWS_REGION"])
+        self.assertEqual("eu-west-2", targets[1].env["AWS_DEFAULT_REGION"])
+        with open("logs/222222222222-eu-west-1.log", "r") as fp:
+            self.assertIn("--stack-name Other-A ", fp.read())
+        output = re.sub(r"\d+\.\ds", "0.0s", stdout.getvalue())
+        # After whatever the StackProvisioners printed
+        self.assertEqual(
+            """account              eu-west-1       eu-west-2
+111111111111           ok 0.0s     FAILED 0.0s
+222222222222           ok 0.0s               -
+111111111111-eu-west-2: Failed to deploy stacks: A (see logs/111111111111-eu-west-2.log)
+""",
+            output[output.rindex("account ") :],
+        )
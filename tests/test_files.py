@@ -0,0 +1,51 @@
+import os
+import tempfile
+from unittest import TestCase
+from provisioner.files import walk_files, replace_file
+
+
+class TestFiles(TestCase):
+    def setUp(self):
+        cwd = os.getcwd()
+        tmp = tempfile.TemporaryDirectory()
+        os.chdir(tmp.name)
+        self.addCleanup(tmp.cleanup)
+        self.addCleanup(os.chdir, cwd)
+
+    def write(self, name, content=""):
+        os.makedirs(os.path.dirname(name) or ".", exist_ok=True)
+        with open(name, "w") as fp:
+            fp.write(content)
+
+    def test_walk_files(self):
+        for name in ["d/b", "d/a/x", "d/.env", "d/.git/HEAD", "d/c/y"]:
+            self.write(name)
+        self.assertEqual(
+            [
+                ("b", os.path.join("d", "b")),
+                ("a/x", os.path.join("d", "a", "x")),
+                ("c/y", os.path.join("d", "c", "y")),
+            ],
+            list(walk_files("d")),
+        )
+
+    def test_replace_file(self):
+        self.write("cache.json", "old")
+        # Two writers of one file in one process don't share a temporary file
+        with replace_file("cache.json") as first, replace_file("cache.json") as second:
+            self.assertNotEqual(first.name, second.name)
+            first.write("first")
+            second.write("second")
+            with open("cache.json", "r") as fp:
+                self.assertEqual("old", fp.read())
+        with open("cache.json", "r") as fp:
+            self.assertEqual("first", fp.read())
+        self.assertEqual(0o600, os.stat("cache.json").st_mode & 0o777)
+        # A failed write leaves the old file and no temporary one
+        with self.assertRaises(ValueError):
+            with replace_file("cache.json") as fp:
+                fp.write("partial")
+                raise ValueError()
+        with open("cache.json", "r") as fp:
+            self.assertEqual("first", fp.read())
+        self.assertEqual(["cache.json"], os.listdir("."))
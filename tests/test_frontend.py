@@ -0,0 +1,269 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from unittest import TestCase
+from provisioner.frontend import FrontendPublisher
+
+
+class FakeS3AWSCommandRunner:
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+        self.calls = []
+        self.fail_parts = False
+        # The most part files on disk at once
+        self.max_staged = 0
+
+    def aws(self, cmd, **kwargs):
+        def arg(name):
+            return cmd[cmd.index(name) + 1]
+
+        with self.lock:
+            self.calls.append(cmd[1])
+        if cmd[1] == "list-objects-v2":
+            contents = [
+                {"Key": key, "ETag": o["ETag"]}
+                for key, o in sorted(self.objects.items())
+                if key.startswith(arg("--prefix"))
+            ]
+            return (json.dumps({"Contents": contents}) if contents else ""), ""
+        if cmd[1] == "put-object":
+            with open(arg("--body"), "rb") as fp:
+                etag = f'"{hashlib.md5(fp.read()).hexdigest()}"'
+            self.objects[arg("--key")] = {
+                "ETag": etag,
+                "ContentType": arg("--content-type"),
+                "CacheControl": arg("--cache-control"),
+            }
+            return json.dumps({"ETag": etag}), ""
+        if cmd[1] == "create-multipart-upload":
+            upload_id = f"upload-{len(self.uploads)}"
+            self.uploads[upload_id] = {
+                "ContentType": arg("--content-type"),
+                "CacheControl": arg("--cache-control"),
+                "Parts": {},
+            }
+            return json.dumps({"UploadId": upload_id}), ""
+        if cmd[1] == "upload-part":
+            if self.fail_parts:
+                raise Exception("part failed")
+            with open(arg("--body"), "rb") as fp:
+                data = fp.read()
+            with self.lock:
+                self.max_staged = max(
+                    self.max_staged, len(os.listdir(os.path.dirname(arg("--body"))))
+                )
+                self.uploads[arg("--upload-id")]["Parts"][
+                    int(arg("--part-number"))
+                ] = data
+            return json.dumps({"ETag": f'"{hashlib.md5(data).hexdigest()}"'}), ""
+        if cmd[1] == "complete-multipart-upload":
+            upload = self.uploads.pop(arg("--upload-id"))
+            parts = json.loads(arg("--multipart-upload"))["Parts"]
+            self.assert_parts = [p["PartNumber"] for p in parts]
+            digests = [
+                hashlib.md5(upload["Parts"][p["PartNumber"]]).digest() for p in parts
+            ]
+            self.objects[arg("--key")] = {
+                "ETag": f'"{hashlib.md5(b"".join(digests)).hexdigest()}-{len(parts)}"',
+                "ContentType": upload["ContentType"],
+                "CacheControl": upload["CacheControl"],
+            }
+            return "", ""
+        if cmd[1] == "abort-multipart-upload":
+            del self.uploads[arg("--upload-id")]
+            return "", ""
+        if cmd[1] == "delete-objects":
+            for o in json.loads(arg("--delete"))["Objects"]:
+                del self.objects[o["Key"]]
+            return "", ""
+        raise Exception(f"Unexpected command {cmd}")
+
+
+class TestFrontendPublisher(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.build_dir = tmp.name
+        self.write("index.html", "<html></html>")
+        self.write("assets/app.3f2a9c1b.js", "console.log(1)")
+        self.write("assets/app.3f2a9c1b.css", "body {}")
+        self.write("favicon.ico", "icon")
+        self.write(".DS_Store", "ignored")
+        self.aws_command_runner = FakeS3AWSCommandRunner()
+
+    def write(self, name, content):
+        path = os.path.join(self.build_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fp:
+            fp.write(content)
+
+    def publisher(self, **p):
+        return FrontendPublisher(
+            self.aws_command_runner, "frontend", self.build_dir, **p
+        )
+
+    def test_publish_only_changes(self):
+        result = self.publisher().publish()
+        self.assertEqual(
+            [
+                "assets/app.3f2a9c1b.css",
+                "assets/app.3f2a9c1b.js",
+                "favicon.ico",
+                "index.html",
+            ],
+            result["uploaded"],
+        )
+        self.assertEqual(
+            {
+                "ETag": '"' + hashlib.md5(b"console.log(1)").hexdigest() + '"',
+                "ContentType": "text/javascript; charset=utf-8",
+                "CacheControl": "public, max-age=31536000, immutable",
+            },
+            self.aws_command_runner.objects["assets/app.3f2a9c1b.js"],
+        )
+        self.assertEqual(
+            "no-cache", self.aws_command_runner.objects["index.html"]["CacheControl"]
+        )
+        self.assertEqual(
+            "text/html; charset=utf-8",
+            self.aws_command_runner.objects["index.html"]["ContentType"],
+        )
+        puts = [c for c in self.aws_command_runner.calls if c == "put-object"]
+        self.assertEqual(4, len(puts))
+
+        # Nothing changed
+        self.aws_command_runner.calls = []
+        result = self.publisher().publish()
+        self.assertEqual(
+            {"uploaded": [], "unchanged": 4, "deleted": []},
+            result,
+        )
+        self.assertEqual(["list-objects-v2"], self.aws_command_runner.calls)
+
+        # A new build replaces a hashed asset and changes index.html
+        os.remove(os.path.join(self.build_dir, "assets/app.3f2a9c1b.js"))
+        self.write("assets/app.0badf00d.js", "console.log(2)")
+        self.write("index.html", "<html>2</html>")
+        result = self.publisher().publish()
+        self.assertEqual(
+            {
+                "uploaded": ["assets/app.0badf00d.js", "index.html"],
+                "unchanged": 2,
+                "deleted": ["assets/app.3f2a9c1b.js"],
+            },
+            result,
+        )
+        self.assertNotIn("assets/app.3f2a9c1b.js", self.aws_command_runner.objects)
+
+    def test_upload_order(self):
+        order = []
+        real_aws = self.aws_command_runner.aws
+
+        def aws(cmd, **kwargs):
+            if cmd[1] == "put-object":
+                order.append(cmd[cmd.index("--key") + 1])
+            return real_aws(cmd, **kwargs)
+
+        self.aws_command_runner.aws = aws
+        self.publisher(max_workers=1).publish()
+        self.assertEqual(
+            ["assets/app.3f2a9c1b.css", "assets/app.3f2a9c1b.js"], sorted(order[:2])
+        )
+        self.assertEqual(["favicon.ico", "index.html"], sorted(order[2:]))
+
+    def test_prefix_and_keep_stale(self):
+        self.aws_command_runner.objects["app/old.txt"] = {"ETag": '"x"'}
+        self.aws_command_runner.objects["other/file.txt"] = {"ETag": '"x"'}
+        result = self.publisher(prefix="app/").publish(delete=False)
+        self.assertIn("app/index.html", result["uploaded"])
+        self.assertEqual([], result["deleted"])
+        self.assertIn("app/old.txt", self.aws_command_runner.objects)
+        result = self.publisher(prefix="app/").publish()
+        self.assertEqual(["app/old.txt"], result["deleted"])
+        # Outside the prefix isn't touched
+        self.assertIn("other/file.txt", self.aws_command_runner.objects)
+
+    def test_multipart(self):
+        self.write("assets/big.0123456789.bin", "x" * 10 + "y" * 10 + "z" * 5)
+        publisher = self.publisher()
+        publisher.multipart_threshold = 20
+        publisher.part_size = 10
+        publisher.publish()
+        self.assertEqual(
+            3,
+            self.aws_command_runner.calls.count("upload-part"),
+        )
+        self.assertEqual([1, 2, 3], self.aws_command_runner.assert_parts)
+        big = self.aws_command_runner.objects["assets/big.0123456789.bin"]
+        self.assertTrue(big["ETag"].endswith('-3"'))
+        self.assertEqual("application/octet-stream", big["ContentType"])
+        # The multipart ETag is computed locally, so it isn't uploaded again
+        self.aws_command_runner.calls = []
+        self.assertEqual([], publisher.publish()["uploaded"])
+
+    def test_multipart_parts_on_disk_are_bounded(self):
+        self.write("big.bin", "".join(str(i % 10) * 10 for i in range(20)))
+        publisher = self.publisher(max_workers=2)
+        publisher.multipart_threshold = 20
+        publisher.part_size = 10
+        publisher.publish()
+        self.assertEqual(list(range(1, 21)), self.aws_command_runner.assert_parts)
+        self.assertLessEqual(self.aws_command_runner.max_staged, 2)
+        self.assertEqual(
+            publisher.etag(os.path.join(self.build_dir, "big.bin")),
+            self.aws_command_runner.objects["big.bin"]["ETag"],
+        )
+
+    def test_failed_multipart_upload_is_aborted(self):
+        self.write("big.bin", "x" * 30)
+        publisher = self.publisher()
+        publisher.multipart_threshold = 20
+        publisher.part_size = 10
+        self.aws_command_runner.fail_parts = True
+        with self.assertRaises(Exception) as cm:
+            publisher.publish()
+        self.assertEqual("part failed", str(cm.exception))
+        self.assertIn("abort-multipart-upload", self.aws_command_runner.calls)
+        self.assertEqual({}, self.aws_command_runner.uploads)
+
+    def test_delete_batches(self):
+        for i in range(2500):
+            self.aws_command_runner.objects[f"stale/{i}"] = {"ETag": '"x"'}
+        result = self.publisher().publish()
+        self.assertEqual(2500, len(result["deleted"]))
+        self.assertEqual(3, self.aws_command_runner.calls.count("delete-objects"))
+        self.assertEqual(4, len(self.aws_command_runner.objects))
+
+    def test_delete_errors(self):
+        self.aws_command_runner.objects["stale"] = {"ETag": '"x"'}
+        real_aws = self.aws_command_runner.aws
+
+        def aws(cmd, **kwargs):
+            if cmd[1] == "delete-objects":
+                return (
+                    json.dumps(
+                        {
+                            "Errors": [
+                                {
+                                    "Key": "stale",
+                                    "Code": "AccessDenied",
+                                    "Message": "Access Denied",
+                                }
+                            ]
+                        }
+                    ),
+                    "",
+                )
+            return real_aws(cmd, **kwargs)
+
+        self.aws_command_runner.aws = aws
+        with self.assertRaises(Exception) as cm:
+            self.publisher().publish()
+        self.assertEqual(
+            "Failed to delete 1 objects from 'frontend', e.g. stale: Access Denied",
+            str(cm.exception),
+        )
@@ -0,0 +1,98 @@
+import os
+import json
+import tempfile
+from unittest import TestCase
+from concurrent.futures import ThreadPoolExecutor
+from provisioner import CommandRunner, AWSCommandRunner, ExecError
+from provisioner.fake_aws import FakeAWS
+from provisioner.multipart import upload_file
+
+env = dict(
+    AWS_REGION="eu-west-2",
+    AWS_ACCESS_KEY_ID="test",
+    AWS_SECRET_ACCESS_KEY="test",
+    PATH="",
+)
+
+
+class TestUploadFile(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "data.bin")
+        with open(self.path, "wb") as fp:
+            fp.write(os.urandom(95))
+        self.fake = FakeAWS(account="123456789012", user="user")
+        self.fake.buckets["b"] = {
+            "region": "eu-west-2",
+            "versioning": "",
+            "objects": {},
+        }
+        self.aws_command_runner = AWSCommandRunner(
+            CommandRunner(logfilename=os.path.join(tmp.name, "test.log"), env=env),
+            "eu-west-2",
+            "123456789012",
+            "user",
+            backend=self.fake.backend,
+            rate_limits={},
+        )
+
+    def calls(self):
+        return [
+            call for _, call in self.fake.calls if call != "sts get-caller-identity"
+        ]
+
+    def test_put_object(self):
+        upload_file(
+            self.aws_command_runner,
+            "b",
+            "k",
+            self.path,
+            ["--content-type", "application/zip"],
+            multipart_threshold=100,
+        )
+        self.assertEqual(["s3api put-object"], self.calls())
+        self.assertEqual(
+            "application/zip", self.fake.buckets["b"]["objects"]["k"]["ContentType"]
+        )
+
+    def test_multipart(self):
+        for part_executor in [None, ThreadPoolExecutor(max_workers=3)]:
+            self.fake.calls = []
+            upload_file(
+                self.aws_command_runner,
+                "b",
+                "k",
+                self.path,
+                multipart_threshold=10,
+                part_size=10,
+                max_parts=2,
+                part_executor=part_executor,
+            )
+            self.assertEqual(10, self.calls().count("s3api upload-part"))
+            self.assertEqual("s3api complete-multipart-upload", self.calls()[-1])
+            stdout, _ = self.aws_command_runner.aws(
+                ["s3api", "head-object", "--bucket", "b", "--key", "k"]
+            )
+            self.assertEqual(95, json.loads(stdout)["ContentLength"])
+
+    def test_failed_part_aborts(self):
+        self.fake.fail("s3api upload-part", code="AccessDenied", message="Denied")
+        with ThreadPoolExecutor(max_workers=2) as part_executor:
+            with self.assertRaises(ExecError):
+                upload_file(
+                    self.aws_command_runner,
+                    "b",
+                    "k",
+                    self.path,
+                    multipart_threshold=10,
+                    part_size=10,
+                    max_parts=2,
+                    part_executor=part_executor,
+                )
+        calls = self.calls()
+        self.assertEqual("s3api abort-multipart-upload", calls[-1])
+        # Stopped at the failure rather than sending every part
+        self.assertLess(calls.count("s3api upload-part"), 10)
+        self.assertEqual({}, self.fake._uploads)
+        self.assertNotIn("k", self.fake.buckets["b"]["objects"])
@@ -0,0 +1,150 @@
+import io
+import os
+import stat
+import zipfile
+import tempfile
+import contextlib
+from unittest import TestCase
+from provisioner import CommandRunner, AWSCommandRunner, ExecError
+from provisioner.fake_aws import FakeAWS
+from provisioner.packager import LambdaPackager, build, tree_hash
+
+env = dict(
+    AWS_REGION="eu-west-2",
+    AWS_ACCESS_KEY_ID="test",
+    AWS_SECRET_ACCESS_KEY="test",
+    PATH="",
+)
+
+
+class TestLambdaPackager(TestCase):
+    def setUp(self):
+        cwd = os.getcwd()
+        tmp = tempfile.TemporaryDirectory()
+        os.chdir(tmp.name)
+        self.addCleanup(tmp.cleanup)
+        self.addCleanup(os.chdir, cwd)
+        self.write("api/handler.py", "def handler(event, context):\n    pass\n")
+        self.write("api/lib/util.py", "X = 1\n")
+        self.write("api/bin/tool", "#!/bin/sh\n")
+        os.chmod("api/bin/tool", 0o755)
+        self.write("api/.venv/ignored.py", "")
+        self.write("worker/handler.py", "def handler(event, context):\n    pass\n")
+        self.fake = FakeAWS(account="123456789012", user="user")
+        self.fake.buckets["artifacts"] = {
+            "region": "eu-west-2",
+            "versioning": "Enabled",
+            "objects": {},
+        }
+        self.aws_command_runner = AWSCommandRunner(
+            CommandRunner(logfilename="test.log", env=env),
+            "eu-west-2",
+            "123456789012",
+            "user",
+            backend=self.fake.backend,
+            rate_limits={},
+        )
+
+    def write(self, name, content):
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        with open(name, "w") as fp:
+            fp.write(content)
+
+    def package(self, packager=None):
+        packager = packager or LambdaPackager(
+            self.aws_command_runner, "artifacts", prefix="lambda/", max_workers=2
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            return packager.package({"api": "api", "worker": "worker"})
+
+    def test_reproducible_zip(self):
+        os.mkdir("cache1")
+        os.mkdir("cache2")
+        tree, first, built = build("api", "cache1")
+        self.assertTrue(built)
+        # Touching files doesn't change the zip
+        os.utime("api/handler.py", (0, 0))
+        self.assertEqual(
+            (tree, "cache2/" + f"{tree}.zip", True), build("api", "cache2")
+        )
+        with open(first, "rb") as a, open(f"cache2/{tree}.zip", "rb") as b:
+            self.assertEqual(a.read(), b.read())
+        with zipfile.ZipFile(first) as zf:
+            self.assertEqual(["bin/tool", "handler.py", "lib/util.py"], zf.namelist())
+            infos = {info.filename: info for info in zf.infolist()}
+        self.assertEqual((1980, 1, 1, 0, 0, 0), infos["handler.py"].date_time)
+        self.assertEqual(0o755, stat.S_IMODE(infos["bin/tool"].external_attr >> 16))
+        self.assertEqual(0o644, stat.S_IMODE(infos["handler.py"].external_attr >> 16))
+        # Already in the cache
+        self.assertEqual((tree, first, False), build("api", "cache1"))
+        # Content and the executable bit change the hash
+        os.chmod("api/handler.py", 0o755)
+        self.assertNotEqual(tree, tree_hash("api"))
+
+    def test_incremental(self):
+        packages = self.package()
+        self.assertEqual(
+            {"built": True, "uploaded": True, "bucket": "artifacts"},
+            {k: packages["api"][k] for k in ["built", "uploaded", "bucket"]},
+        )
+        key = packages["api"]["key"]
+        self.assertEqual(f"lambda/api/{tree_hash('api')}.zip", key)
+        objects = self.fake.buckets["artifacts"]["objects"]
+        self.assertEqual("application/zip", objects[key]["ContentType"])
+
+        # Nothing changed, nothing is built or uploaded
+        self.fake.calls = []
+        packages = self.package()
+        self.assertEqual(
+            [False, False],
+            [packages["api"]["built"], packages["worker"]["uploaded"]],
+        )
+        self.assertEqual(
+            ["s3api head-object", "s3api head-object"],
+            [call for _, call in self.fake.calls],
+        )
+
+        # Only the changed function
+        self.write("worker/handler.py", "def handler(event, context):\n    return 1\n")
+        packages = self.package()
+        self.assertEqual(key, packages["api"]["key"])
+        self.assertFalse(packages["api"]["uploaded"])
+        self.assertTrue(packages["worker"]["built"])
+        self.assertTrue(packages["worker"]["uploaded"])
+        self.assertEqual(3, len(objects))
+
+    def test_multipart(self):
+        self.write("api/data.bin", "".join(str(i) for i in range(20000)))
+        packager = LambdaPackager(
+            self.aws_command_runner, "artifacts", max_workers=1, max_uploads=2
+        )
+        packager.multipart_threshold = 10000
+        packager.part_size = 10000
+        packages = self.package(packager)
+        size = os.path.getsize(f".lambda-cache/{packages['api']['hash']}.zip")
+        parts = -(-size // 10000)
+        self.assertGreater(parts, 2)
+        calls = [call for _, call in self.fake.calls]
+        self.assertEqual(parts, calls.count("s3api upload-part"))
+        obj = self.fake.buckets["artifacts"]["objects"][packages["api"]["key"]]
+        self.assertTrue(obj["ETag"].endswith(f'-{parts}"'))
+        self.assertEqual(size, obj["ContentLength"])
+
+    def test_failed_multipart_upload_is_aborted(self):
+        packager = LambdaPackager(self.aws_command_runner, "artifacts", max_workers=1)
+        packager.multipart_threshold = 100
+        packager.part_size = 100
+        self.fake.fail("s3api upload-part", code="AccessDenied", message="Denied")
+        with self.assertRaises(ExecError):
+            self.package(packager)
+        self.assertIn(
+            "s3api abort-multipart-upload", [call for _, call in self.fake.calls]
+        )
+        self.assertEqual({}, self.fake._uploads)
+
+    def test_empty_function(self):
+        os.mkdir("empty")
+        packager = LambdaPackager(self.aws_command_runner, "artifacts", max_workers=1)
+        with self.assertRaises(Exception) as cm:
+            packager.package({"empty": "empty"})
+        self.assertEqual("There are no files to package in 'empty'", str(cm.exception))
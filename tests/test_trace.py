@@ -0,0 +1,122 @@
+import os
+import asyncio
+import tempfile
+from unittest import TestCase
+from provisioner import CommandRunner, AsyncCommandRunner, ExecError
+from provisioner.trace import read_trace, operation, summarise
+
+path = os.environ["PATH"]
+logfilename = "test.log"
+
+
+class TestTrace(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.trace = os.path.join(tmp.name, "trace.jsonl")
+
+    def test_command_runner_trace(self):
+        command_runner = CommandRunner(
+            logfilename=logfilename, cwd="/", env=dict(PATH=path), trace=self.trace
+        )
+        command_runner.exec(["echo", "hello"], log_name="[a] ")
+        with self.assertRaises(ExecError):
+            command_runner.exec(["sh", "-c", "echo err 1>&2 && exit 3"])
+        records = read_trace(self.trace)
+        self.assertEqual(2, len(records))
+        self.assertEqual(
+            {
+                "argv": ["echo", "hello"],
+                "cwd": "/",
+                "log_name": "[a] ",
+                "exit_code": 0,
+                "stdout_bytes": 6,
+                "stderr_bytes": 0,
+            },
+            {
+                k: v
+                for k, v in records[0].items()
+                if k not in ["start", "end", "duration"]
+            },
+        )
+        self.assertEqual(3, records[1]["exit_code"])
+        self.assertEqual(4, records[1]["stderr_bytes"])
+        for record in records:
+            self.assertAlmostEqual(
+                record["end"] - record["start"], record["duration"], places=6
+            )
+        self.assertLessEqual(records[0]["end"], records[1]["start"])
+
+    def test_async_command_runner_trace(self):
+        command_runner = AsyncCommandRunner(
+            logfilename=logfilename, env=dict(PATH=path), trace=self.trace
+        )
+        asyncio.run(command_runner.exec(["echo", "hello"]))
+        (record,) = read_trace(self.trace)
+        self.assertEqual(["echo", "hello"], record["argv"])
+        self.assertEqual(6, record["stdout_bytes"])
+
+    def test_no_trace(self):
+        command_runner = CommandRunner(logfilename=logfilename, env=dict(PATH=path))
+        self.assertIsNone(command_runner.trace_file)
+        command_runner.exec(["true"])
+
+    def test_operation(self):
+        self.assertEqual(
+            "s3api get-bucket-versioning",
+            operation(
+                [
+                    "awslocal",
+                    "--region=eu-west-2",
+                    "s3api",
+                    "get-bucket-versioning",
+                    "--bucket",
+                    "b",
+                ]
+            ),
+        )
+        self.assertEqual(
+            "sts get-caller-identity",
+            operation(["botocore", "sts", "get-caller-identity"]),
+        )
+        self.assertEqual("localstack", operation(["/usr/bin/localstack", "start"]))
+
+    def test_summarise(self):
+        def record(argv, start, duration, exit_code=0):
+            return {
+                "argv": argv,
+                "cwd": "/",
+                "log_name": "",
+                "start": start,
+                "end": start + duration,
+                "duration": duration,
+                "exit_code": exit_code,
+                "stdout_bytes": 0,
+                "stderr_bytes": 0,
+            }
+
+        records = [
+            record(["aws", "--region=eu-west-2", "sts", "get-caller-identity"], 0, 1),
+            record(["aws", "--region=eu-west-2", "cloudformation", "deploy"], 1, 30),
+            record(
+                ["aws", "--region=eu-west-2", "cloudformation", "deploy"], 2, 40, 255
+            ),
+            record(["aws", "--region=eu-west-2", "x" * 200], 3, 0.5),
+        ]
+        self.assertEqual(
+            """Slowest commands:
+     40.000s  exit 255  aws --region=eu-west-2 cloudformation deploy
+     30.000s  exit 0    aws --region=eu-west-2 cloudformation deploy
+
+Time per service/operation:
+     70.000s      2 calls  cloudformation deploy
+      1.000s      1 calls  sts get-caller-identity
+      0.500s      1 calls  """
+            + "x" * 200
+            + """
+
+4 commands took 71.500s in total over 42.000s of wall clock time
+""",
+            summarise(records, top=2),
+        )
+        self.assertEqual("No commands traced\n", summarise([]))